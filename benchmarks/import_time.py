@@ -0,0 +1,56 @@
+"""Cold-start cost of importing databox
+
+Each case runs in a fresh interpreter and reports wall time, peak RSS, and
+which of the heavy optional dependencies ended up in sys.modules. The eager
+case imports the plotting/stats stack up front the way databox used to.
+
+    python benchmarks/import_time.py [repeats]
+"""
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib.pyplot', 'scipy.stats', 'geopy',
+                 'mpl_toolkits.basemap', 'facebook']
+
+CASES = [
+    ('import databox', 'import databox'),
+    ('import databox.fb', 'import databox.fb'),
+    ('mongo_to_df only', 'from databox import mongo_to_df'),
+    ('eager plotting/stats', 'import databox; import matplotlib.pyplot; '
+                             'import scipy.stats'),
+]
+
+CHILD = """
+import resource, sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+loaded = [m for m in %r if m in sys.modules]
+print('%%f %%d %%s' %% (elapsed, rss, ','.join(loaded)))
+"""
+
+def run_case(statement, repeats=5):
+    """
+    Best-of-repeats import time in seconds, peak RSS in kB, and the heavy
+    modules loaded by statement
+    """
+    results = []
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       CHILD % (statement, HEAVY_MODULES)])
+        elapsed, rss, loaded = (out.decode().strip().split(' ') + [''])[:3]
+        results.append((float(elapsed), int(rss), loaded))
+
+    return min(results)
+
+def main(repeats=5):
+    print('%-22s %10s %10s  %s' % ('case', 'time (ms)', 'rss (MB)', 'loaded'))
+    for name, statement in CASES:
+        elapsed, rss, loaded = run_case(statement, repeats)
+        print('%-22s %10.1f %10.1f  %s' % (name, elapsed * 1000, rss / 1024.,
+                                           loaded or '-'))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -3,63 +3,635 @@ The databox module is a collection of useful data-related
 functions, including handling, analysis, and visualization
 """
 
-import matplotlib.pyplot as plt 
+import collections
+import datetime
+import hashlib
+import importlib
+import itertools
+import json
+import numbers
 import numpy as np 
+import os
 import pandas as pd 
-import scipy.stats as stats
+import shutil
+import tempfile
+import types
+
+from multiprocessing.pool import ThreadPool
 # from pymongo import MongoClient()
 
 #------------------------------------------------------------------------    
 
-def mongo_to_df(collection, query={}, fields=None):
+class _LazyModule(types.ModuleType):
+    """Stand-in for a module that is only imported on first attribute access, 
+    so that e.g. mongo_to_df users never load the plotting stack
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+plt = _LazyModule('matplotlib.pyplot')
+stats = _LazyModule('scipy.stats')
+
+#------------------------------------------------------------------------    
+
+def mongo_to_df(collection, query={}, fields=None, batch_size=1000, dtypes=None, 
+                flatten=False, chunksize=None, partitions=None, partition_key='_id', 
+                max_workers=4, cache_dir=None, refresh_key='_id', cache_max_bytes=2**30):
     """return a mongo query as a DataFrame
+
+    Documents are pulled from the cursor batch_size at a time and appended to 
+    per-column buffers, so only one batch of documents is alive at once. 
+    dtypes maps column names to declared dtypes, and flatten=True expands 
+    nested documents into dotted column names (e.g. 'user.name'). Columns 
+    are sorted by name, except that an OrderedDict of dtypes puts its 
+    columns first, in its order. With chunksize set, a generator yielding 
+    one DataFrame per chunksize documents is returned instead
+
+    partitions splits the query into disjoint partition_key ranges that are 
+    read concurrently by at most max_workers threads sharing the collection's 
+    client. It is either a number of ranges, spread evenly between the 
+    smallest and largest key (numbers, datetimes or ObjectIds), or a sorted 
+    list of split points. Partitions are concatenated in key order, followed 
+    by the documents whose partition_key is missing, null or of another type
+
+    cache_dir enables an on-disk cache, one column-per-file entry per 
+    collection, query, projection, flatten and dtypes. A cached result is refreshed by 
+    fetching only documents whose refresh_key is above the cached maximum, 
+    so refresh_key should increase with insertion (_id or a creation 
+    timestamp); updates and deletions of older documents are not seen. 
+    Least recently used entries are evicted beyond cache_max_bytes
     """
 
+    if cache_dir:
+        if chunksize:
+            raise ValueError('chunksize cannot be combined with cache_dir')
+        return _cached_mongo_to_df(collection, query, fields, cache_dir, refresh_key, 
+                                   cache_max_bytes, batch_size=batch_size, dtypes=dtypes, 
+                                   flatten=flatten, partitions=partitions, 
+                                   partition_key=partition_key, max_workers=max_workers)
+
+    if partitions:
+        if chunksize:
+            raise ValueError('chunksize cannot be combined with partitions')
+        
+        if not isinstance(partitions, (list, tuple)):
+            partitions = _partition_bounds(collection, query, partition_key, partitions)
+        queries = _partition_queries(query, partition_key, partitions)
+
+        pool = ThreadPool(min(max_workers, len(queries)))
+        try:
+            frames = pool.map(
+                lambda partition_query: _read_mongo_frame(collection, partition_query, 
+                                            fields, batch_size, dtypes, flatten), 
+                queries)
+        finally:
+            pool.close()
+
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        return df[_column_order(df.columns, dtypes)]
+
+    if chunksize:
+        records = collection.find(query, projection=fields)
+        if hasattr(records, 'batch_size'):
+            records = records.batch_size(batch_size)
+        return _iter_mongo_frames(records, chunksize, dtypes, flatten)
+    
+    return _read_mongo_frame(collection, query, fields, batch_size, dtypes, flatten)
+
+#------------------------------------------------------------------------    
+
+def _read_mongo_frame(collection, query, fields, batch_size, dtypes=None, flatten=False):
     records = collection.find(query, projection=fields)
+    if hasattr(records, 'batch_size'):
+        records = records.batch_size(batch_size)
+
+    buffers = _ColumnBuffers(dtypes, flatten)
+    for batch in _iter_batches(records, batch_size):
+        buffers.append(batch)
+    
+    return buffers.to_frame()
+
+def _partition_bounds(collection, query, key, n_partitions):
+    """Split points dividing the range of key among matching documents 
+    into n_partitions equal-width ranges
+    """
+
+    def key_extreme(condition, direction):
+        key_query = {'$and': [query, {key: condition}]} if query else {key: condition}
+        cursor = collection.find(key_query, projection={key: 1}).sort(key, direction).limit(1)
+        for document in cursor:
+            return document.get(key)
+
+    # documents without the key (or with a null) sort first, and range 
+    # operators only match values of low's type; the documents left out 
+    # are read by the extra partition _partition_queries adds
+    low = key_extreme({'$exists': True, '$ne': None}, 1)
+    if low is None:
+        return []
+    high = key_extreme({'$gte': low}, -1)
+    if low == high:
+        return []
+
+    if hasattr(low, 'generation_time'):
+        # ObjectIds are split on their embedded creation time
+        from bson import ObjectId
+        low, high = low.generation_time, high.generation_time
+        return [ObjectId.from_datetime(low + (high - low) * i // n_partitions) 
+                for i in range(1, n_partitions)]
+
+    if isinstance(low, datetime.datetime):
+        return [low + (high - low) * i // n_partitions for i in range(1, n_partitions)]
+
+    if isinstance(low, numbers.Number):
+        return list(np.linspace(low, high, n_partitions + 1)[1:-1])
+
+    raise ValueError(
+        'cannot split %s values of %r evenly; pass a list of split points' 
+        % (type(low).__name__, key))
+
+def _partition_queries(query, key, bounds):
+    """One query per range: below the first split point, between consecutive 
+    split points, and from the last split point up, plus one for documents 
+    matching none of them (key missing, null or of another type)
+    """
+
+    ranges = []
+    for low, high in zip([None] + list(bounds), list(bounds) + [None]):
+        clause = {}
+        if low is not None:
+            clause['$gte'] = low
+        if high is not None:
+            clause['$lt'] = high
+        ranges.append({key: clause} if clause else {})
+    if bounds:
+        ranges.append({'$nor': list(ranges)})
+
+    if not query:
+        return ranges
+
+    return [{'$and': [query, key_range]} if key_range else query for key_range in ranges]
+
+def _cached_mongo_to_df(collection, query, fields, cache_dir, refresh_key, max_bytes, 
+                        **read_options):
+    entry = os.path.join(cache_dir, _mongo_cache_key(collection, query, fields, 
+                                                      read_options['flatten'], 
+                                                      read_options['dtypes']))
+
+    df = None
+    if os.path.isdir(entry):
+        df = _read_columns(entry)
+        if refresh_key not in df.columns or len(df) == 0:
+            df = None
+
+    if df is None:
+        df = mongo_to_df(collection, query, fields, **read_options)
+    else:
+        high_water = _to_python_scalar(df[refresh_key].max())
+        newer_query = {refresh_key: {'$gt': high_water}}
+        if query:
+            newer_query = {'$and': [query, newer_query]}
+
+        newer_df = mongo_to_df(collection, newer_query, fields, **read_options)
+        if len(newer_df) == 0:
+            os.utime(os.path.join(entry, 'meta.json'), None)
+            return df
+        df = pd.concat([df, newer_df], ignore_index=True, sort=False)
+        df = df[_column_order(df.columns, read_options['dtypes'])]
+
+    _write_columns(df, entry)
+    _evict_lru(cache_dir, max_bytes, keep=entry)
+
+    return df
+
+def _mongo_cache_key(collection, query, fields, flatten=False, dtypes=None):
+    name = getattr(collection, 'full_name', None) or getattr(collection, 'name', '')
+    # flatten and dtypes change the columns stored, so they are part of the key
+    dtypes = sorted((column, str(dtype)) for column, dtype in (dtypes or {}).items())
+    description = json.dumps([name, query, fields, bool(flatten), dtypes], 
+                             sort_keys=True, default=repr)
+
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+def _to_python_scalar(value):
+    """Convert NumPy and pandas scalars to types the mongo driver can encode
+    """
+
+    if hasattr(value, 'to_pydatetime'):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    
+    return value
+
+def _evict_lru(cache_dir, max_bytes, keep=None):
+    """Remove the least recently used cache entries until the cache fits in 
+    max_bytes. Entries are directories whose meta.json is touched on use
+    """
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta):
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(meta), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+#------------------------------------------------------------------------    
+
+def _write_columns(df, path):
+    """Write a DataFrame as one .npy file per column plus a meta.json 
+    holding the column names, replacing any existing directory at path
+    """
+
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+
+    for i, column in enumerate(df.columns):
+        np.save(os.path.join(tmp_path, '%d.npy' % i), np.asarray(df[column]))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'columns': list(df.columns), 'n_rows': len(df)}, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def _read_columns(path, mmap_mode=None):
+    """Read a DataFrame written by _write_columns. With mmap_mode set, 
+    columns of fixed-width dtypes are memory-mapped rather than read
+    """
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    data = collections.OrderedDict()
+    for i, column in enumerate(meta['columns']):
+        column_path = os.path.join(path, '%d.npy' % i)
+        try:
+            data[column] = np.load(column_path, mmap_mode=mmap_mode, allow_pickle=True)
+        except ValueError:
+            # object columns cannot be memory-mapped
+            data[column] = np.load(column_path, allow_pickle=True)
+
+    return pd.DataFrame(data, columns=meta['columns'], index=pd.RangeIndex(meta['n_rows']))
+
+def _iter_mongo_frames(records, chunksize, dtypes=None, flatten=False):
+    for batch in _iter_batches(records, chunksize):
+        buffers = _ColumnBuffers(dtypes, flatten)
+        buffers.append(batch)
+        yield buffers.to_frame()
+
+def _iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _flatten_document(document, prefix=''):
+    flat = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            flat.update(_flatten_document(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
     
-    return pd.DataFrame(list(records))
+    return flat
+
+class _ColumnBuffers(object):
+    """Column-wise accumulator for batches of documents. Each batch is 
+    converted to one typed Series per column; missing fields become NaN
+    """
+
+    def __init__(self, dtypes=None, flatten=False):
+        self.dtypes = dtypes or {}
+        self.flatten = flatten
+        self.columns = collections.OrderedDict()
+        self.n_rows = 0
+
+    def append(self, documents):
+        if self.flatten:
+            documents = [_flatten_document(document) for document in documents]
+
+        keys = collections.OrderedDict()
+        for document in documents:
+            for key in document:
+                keys[key] = None
+
+        for key in keys:
+            if key not in self.columns:
+                self.columns[key] = [self._missing(self.n_rows)]
+
+        for key, chunks in self.columns.items():
+            values = [document.get(key, np.nan) for document in documents]
+            chunks.append(pd.Series(values, dtype=self.dtypes.get(key)))
+
+        self.n_rows += len(documents)
+
+    def to_frame(self):
+        data = collections.OrderedDict()
+        for key, chunks in self.columns.items():
+            column = pd.concat(chunks, ignore_index=True)
+            if key in self.dtypes:
+                column = column.astype(self.dtypes[key])
+            elif column.dtype == object and len(set(c.dtype for c in chunks)) > 1:
+                # chunks of differing types (e.g. NaN padding and datetimes)
+                # fall back to object; infer a common type from the values
+                column = pd.Series(column.tolist())
+            data[key] = column
+
+        return pd.DataFrame(data, columns=_column_order(data.keys(), self.dtypes), 
+                            index=pd.RangeIndex(self.n_rows))
+
+    @staticmethod
+    def _missing(n_rows):
+        return pd.Series(np.nan, index=pd.RangeIndex(n_rows))
+
+def _column_order(columns, dtypes=None):
+    """Sorted column names, as pd.DataFrame(list_of_dicts) gives; when dtypes 
+    is an OrderedDict its columns come first, in its order
+    """
+
+    columns = list(columns)
+    leading = []
+    if isinstance(dtypes, collections.OrderedDict):
+        leading = [column for column in dtypes if column in columns]
+
+    return leading + sorted(set(columns) - set(leading))
 
 #------------------------------------------------------------------------    
 
-def pca(df):
+def pca(df, n_components=None, solver='auto', random_state=None):
     """Perform a principal components analysis on data in a DataFrame
+
+    n_components limits the analysis to the leading components. solver is one 
+    of 'eigh' (symmetric eigensolver on the correlation matrix), 'svd' 
+    (thin SVD of the normalized data), 'randomized' (approximate truncated 
+    SVD, seeded by random_state) or 'auto', which picks 'svd' for frames 
+    with more columns than rows and 'eigh' otherwise
     """
     
     # normalize the data
-    df_normalized = (df - df.mean()) / df.std()
-    corr_matrix = np.corrcoef(df_normalized, rowvar=0)
-    eig_values, eig_vectors = np.linalg.eig(corr_matrix)
-    
+    data = np.asarray(df, dtype='float')
+    data_normalized = (data - data.mean(axis=0)) / data.std(axis=0, ddof=1)
+
+    n_rows, n_cols = data_normalized.shape
+    if n_components is None:
+        n_components = n_cols
+    n_components = min(n_components, n_cols)
+
+    if solver == 'auto':
+        solver = 'svd' if n_cols > n_rows else 'eigh'
+
+    if solver == 'eigh':
+        corr_matrix = np.dot(data_normalized.T, data_normalized) / (n_rows - 1)
+        eig_values, eig_vectors = _top_eigh(corr_matrix, n_components)
+    elif solver == 'svd':
+        _, singular_values, components = np.linalg.svd(
+                                            data_normalized, full_matrices=False)
+        eig_values = singular_values[:n_components]**2 / (n_rows - 1)
+        eig_vectors = components[:n_components].T
+    elif solver == 'randomized':
+        singular_values, components = _randomized_svd(
+                                data_normalized, n_components, random_state)
+        eig_values = singular_values**2 / (n_rows - 1)
+        eig_vectors = components.T
+    else:
+        raise ValueError("solver must be one of 'auto', 'eigh', 'svd' or 'randomized'")
+
+    # the SVD solvers give at most min(n_rows, n_cols) components
+    eig_values, eig_vectors = _pad_components(eig_values, eig_vectors, n_components)
+
     # sort eig values and eigvectors
-    eig_vectors = np.array(
-                    [v[1] for v in sorted(
-                        zip(eig_values, eig_vectors.transpose()), reverse=True
-                            )]).transpose()
-    eig_values = np.array(sorted(eig_values, reverse=True))
+    order = np.argsort(eig_values)[::-1]
+    eig_values = eig_values[order]
+    eig_vectors = eig_vectors[:, order]
 
     # make eigenvectors primarily positive for easier interpretation
-    for col in range(eig_vectors.shape[1]):
-        if eig_vectors[:,col].sum() < 0:
-            eig_vectors[:,col] = -eig_vectors[:,col]
+    eig_vectors = eig_vectors * np.where(eig_vectors.sum(axis=0) < 0, -1, 1)
     
     # project normalized points to prinipal components
-    projected_points = np.dot(df_normalized.values, eig_vectors)
+    projected_points = np.dot(data_normalized, eig_vectors)
     
     return projected_points, eig_values, eig_vectors
+
+#------------------------------------------------------------------------    
+
+def _pad_components(eig_values, eig_vectors, n_components):
+    """Extend eigenpairs to n_components with zero eigenvalues and an 
+    orthonormal basis of the remaining space, as eigh gives for a 
+    rank-deficient correlation matrix
+    """
+
+    n_found = len(eig_values)
+    if n_found >= n_components:
+        return eig_values, eig_vectors
+
+    # the trailing right singular vectors span the complement
+    complement = np.linalg.svd(eig_vectors.T, full_matrices=True)[2][n_found:n_components]
+    eig_values = np.concatenate([eig_values, np.zeros(n_components - n_found)])
+    eig_vectors = np.hstack([eig_vectors, complement.T])
+
+    return eig_values, eig_vectors
+
+#------------------------------------------------------------------------    
+
+def _top_eigh(symmetric_matrix, n_components):
+    """Leading eigenpairs of a symmetric matrix, computing only the 
+    n_components largest when fewer than all are requested
+    """
+
+    size = symmetric_matrix.shape[0]
+    if n_components < size:
+        import scipy.linalg
+        return scipy.linalg.eigh(
+                symmetric_matrix, eigvals=(size - n_components, size - 1))
+
+    return np.linalg.eigh(symmetric_matrix)
+
+#------------------------------------------------------------------------    
+
+def _randomized_svd(data, n_components, random_state=None, n_oversamples=10, n_iter=4):
+    """Approximate truncated SVD by randomized range finding 
+    (Halko, Martinsson & Tropp 2011). Returns singular values and right 
+    singular vectors (as rows)
+    """
+
+    rng = np.random.RandomState(random_state)
+    n_random = min(n_components + n_oversamples, min(data.shape))
+
+    # power iterations with re-orthonormalization sharpen the spectrum
+    Q = np.dot(data, rng.normal(size=(data.shape[1], n_random)))
+    Q, _ = np.linalg.qr(Q)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(np.dot(data.T, Q))
+        Q, _ = np.linalg.qr(np.dot(data, Q))
+
+    _, singular_values, components = np.linalg.svd(
+                                        np.dot(Q.T, data), full_matrices=False)
+
+    return singular_values[:n_components], components[:n_components]
   
 #------------------------------------------------------------------------    
 
-def plot_pca(projected_points, eig_values, eig_vectors, labels=None):
+class IncrementalPCA(object):
+    """Principal components analysis accumulated over chunks of rows, for 
+    data that does not fit in memory at once. Chunks can be DataFrames 
+    (e.g. from pd.read_csv(..., chunksize=...) or mongo_to_df), arrays, or 
+    slices of a memory-mapped array. Only the running means and co-moment 
+    matrix are kept, so memory is bounded by the number of columns. On data 
+    that fits in memory the results match pca()
+
+    Raw mongo cursor batches (lists of documents) are accepted too. columns 
+    picks the numeric fields of DataFrame and document chunks; by default 
+    all columns but mongo's '_id' are used
+    """
+
+    def __init__(self, n_components=None, columns=None):
+        self.n_components = n_components
+        self.columns = columns
+        self.n_samples = 0
+        self.mean = None
+        self._comoment = None
+        self._eig = None
+
+    def partial_fit(self, chunk):
+        """Update the running means and co-moment matrix with a chunk of rows
+        """
+
+        data = self._chunk_values(chunk)
+        n_chunk = data.shape[0]
+        if n_chunk == 0:
+            return self
+
+        chunk_mean = data.mean(axis=0)
+        centered = data - chunk_mean
+        chunk_comoment = np.dot(centered.T, centered)
+
+        if self.n_samples == 0:
+            self.mean = chunk_mean
+            self._comoment = chunk_comoment
+        else:
+            # pairwise update (Chan, Golub & LeVeque 1979)
+            n_total = self.n_samples + n_chunk
+            delta = chunk_mean - self.mean
+            self._comoment += chunk_comoment + (
+                np.outer(delta, delta) * self.n_samples * n_chunk / float(n_total))
+            self.mean = self.mean + delta * n_chunk / float(n_total)
+
+        self.n_samples += n_chunk
+        self._eig = None
+
+        return self
+
+    def fit(self, chunks):
+        """Accumulate statistics from an iterable of chunks
+        """
+
+        for chunk in chunks:
+            self.partial_fit(chunk)
+
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(np.diag(self._comoment) / (self.n_samples - 1))
+
+    @property
+    def corr_matrix(self):
+        cov = self._comoment / (self.n_samples - 1)
+        std = self.std
+        return cov / np.outer(std, std)
+
+    @property
+    def eig_values(self):
+        return self._components()[0]
+
+    @property
+    def eig_vectors(self):
+        return self._components()[1]
+
+    def transform(self, chunk):
+        """Project a chunk of rows onto the principal components
+        """
+
+        data_normalized = (self._chunk_values(chunk) - self.mean) / self.std
+
+        return np.dot(data_normalized, self.eig_vectors)
+
+    def transform_chunks(self, chunks):
+        """Lazily project an iterable of chunks, yielding one array of 
+        projected points per chunk
+        """
+
+        for chunk in chunks:
+            yield self.transform(chunk)
+
+    def _components(self):
+        if self._eig is None:
+            corr_matrix = self.corr_matrix
+            n_components = self.n_components or corr_matrix.shape[0]
+            n_components = min(n_components, corr_matrix.shape[0])
+
+            eig_values, eig_vectors = _top_eigh(corr_matrix, n_components)
+            order = np.argsort(eig_values)[::-1]
+            eig_values = eig_values[order]
+            eig_vectors = eig_vectors[:, order]
+            eig_vectors = eig_vectors * np.where(eig_vectors.sum(axis=0) < 0, -1, 1)
+
+            self._eig = (eig_values, eig_vectors)
+
+        return self._eig
+
+    def _chunk_values(self, chunk):
+        # a batch of documents from a mongo cursor arrives as a list of dicts
+        if isinstance(chunk, list) and chunk and isinstance(chunk[0], dict):
+            chunk = pd.DataFrame(chunk)
+
+        if isinstance(chunk, pd.DataFrame):
+            if self.columns is None:
+                self.columns = [column for column in chunk.columns if column != '_id']
+            chunk = chunk[self.columns]
+
+        return np.asarray(chunk, dtype='float')
+
+#------------------------------------------------------------------------    
+
+def plot_pca(projected_points, eig_values, eig_vectors, labels=None, density=None, 
+             save=None):
     """Function to plot the first two dimensions of a PCA analysis 
     along with its principal components and (normed) eigenvalues 
+
+    density selects binned rendering of the PCA scatter (see scatter); by 
+    default it is used for more than DENSITY_THRESHOLD points. With save 
+    set, the figure is drawn off-screen and written to that file instead 
+    of being shown
     """
 
     if labels is None:
         labels = range(len(eig_values))
 
-    fig, ax = plt.subplots(2,2, figsize=(10,10))
+    if save:
+        fig = _headless_figure(figsize=(10,10))
+        ax = np.array([[fig.add_subplot(2, 2, 2*row + col + 1) for col in range(2)] 
+                       for row in range(2)])
+    else:
+        fig, ax = plt.subplots(2,2, figsize=(10,10))
 
-    ax[0,1].scatter(projected_points[:,0], projected_points[:,1])
+    scatter(ax[0,1], projected_points[:,0], projected_points[:,1], density=density)
     ax[0,1].set_xlabel('PC1')
     ax[0,1].set_ylabel('PC2')
     ax[0,1].set_title('PCA scatter')
@@ -85,22 +657,106 @@ def plot_pca(projected_points, eig_values, eig_vectors, labels=None):
     ax[1,0].plot(eig_values / eig_values.sum(), lw=2)
     ax[1,0].set_title('Eigenvalues (normalized)')
 
-    plt.show()
+    if save:
+        fig.savefig(save)
+    else:
+        plt.show()
+
+#------------------------------------------------------------------------    
+
+# above this many points, scatter() bins by default instead of drawing markers
+DENSITY_THRESHOLD = 100000
+
+def scatter(ax, x, y, c=None, density=None, bins=200, **kwargs):
+    """Scatter plot on ax that switches to a binned image for large data
+
+    With density=True, or density=None and more than DENSITY_THRESHOLD 
+    points, points are aggregated into a bins x bins 2-D histogram and drawn 
+    as an image, so drawing time depends on the number of bins rather than 
+    the number of points. Bins show point counts (log scale), or the mean 
+    of c when c is given; empty bins are left blank. Returns the artist, 
+    e.g. for plt.colorbar
+    """
+
+    if density is None:
+        density = len(x) > DENSITY_THRESHOLD
+
+    if not density:
+        return ax.scatter(x, y, c=c, **kwargs)
+
+    image, x_edges, y_edges = _density_image(x, y, c, bins)
+    if c is None:
+        from matplotlib.colors import LogNorm
+        kwargs.setdefault('norm', LogNorm())
+
+    return ax.imshow(image, origin='lower', aspect='auto', interpolation='nearest', 
+                     extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]], 
+                     **kwargs)
+
+def _density_image(x, y, c=None, bins=200):
+    """Binned point counts, or mean of c per bin, as a masked image array 
+    along with the bin edges. bins is a number or a pair of edge arrays
+    """
+
+    x, y = np.asarray(x, dtype='float'), np.asarray(y, dtype='float')
+    finite = np.isfinite(x) & np.isfinite(y)
+    if c is not None:
+        c = np.asarray(c, dtype='float')
+        finite &= np.isfinite(c)
+        c = c[finite]
+    x, y = x[finite], y[finite]
+
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+    if c is None:
+        image = np.ma.masked_equal(counts, 0)
+    else:
+        sums, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges], weights=c)
+        with np.errstate(invalid='ignore'):
+            image = np.ma.masked_invalid(sums / counts)
+
+    # histogram2d indexes bins as [x, y]; images are drawn as [row, column]
+    return image.T, x_edges, y_edges
 
 #------------------------------------------------------------------------       
 
-def mc_pca(df, N=99):
+def mc_pca(df, N=99, batch_size=None, n_jobs=1, random_state=None, 
+           sequential=False, alpha=0.05):
     """Take a dataframe and establish the significance of the largest eigenvalue 
     via a monte carlo approach
+
+    Replicates are computed in batches: each batch permutes every column of 
+    the normalized data through an index array, forms the stacked correlation 
+    matrices and takes their eigenvalues in one call. With n_jobs > 1 the 
+    batches are spread over a process pool. Every batch draws from its own 
+    seed derived from random_state, so results do not depend on n_jobs
+
+    With sequential=True, N is the maximum number of replicates and sampling 
+    stops once every eigenvalue's test at level alpha is decided: an 
+    eigenvalue is not significant as soon as it has been exceeded often 
+    enough that its p-value can no longer reach alpha, and significant once 
+    the remaining replicates could not push it over alpha, so decisions 
+    match the fixed-N test. P-values of eigenvalues stopped early for 
+    non-significance follow Besag & Clifford (1991). The 'Replicates' 
+    column reports the replicates used for each eigenvalue. alpha must be 
+    at least 1 / (N + 1), the smallest p-value N replicates can give
     """
 
-    _, observed_eig_values, _ = pca(df) 
+    data = np.asarray(df, dtype='float')
+    data_normalized = (data - data.mean(axis=0)) / data.std(axis=0, ddof=1)
+    observed_eig_values = _corr_eig_values(data_normalized[np.newaxis])[0]
 
-    mc_eig_values = np.zeros((N, df.shape[1]))
-    for n in xrange(N):
-        df_shuffled = shuffle_df(df)
-        _, eig_values, _ = pca(df_shuffled)
-        mc_eig_values[n,:] = eig_values
+    if sequential:
+        if batch_size is None:
+            # small batches let the stopping rule be checked often
+            batch_size = max(1, min(100, _MC_BATCH_VALUES // data_normalized.size))
+        mc_eig_values, replicates, p_values = _sequential_mc(
+                                            observed_eig_values, 
+                                            _iter_mc_eig_values(data_normalized, N, 
+                                                batch_size, n_jobs, random_state),
+                                            N, alpha)
+    else:
+        mc_eig_values = np.concatenate(list(_iter_mc_eig_values(
+                            data_normalized, N, batch_size, n_jobs, random_state)))
 
     #convert eigenvalus array to dataframe for useful functions 
     mc_eig_values = pd.DataFrame(data=mc_eig_values)
@@ -115,16 +771,180 @@ def mc_pca(df, N=99):
     df_summary['Quantile 0.90'] = mc_eig_values.quantile(0.90)
     df_summary['Quantile 0.95'] = mc_eig_values.quantile(0.95)
     df_summary['Quantile 0.99'] = mc_eig_values.quantile(0.99)
-    df_summary['P-value'] = (
-        ((mc_eig_values>=observed_eig_values).sum().values.astype('float') + 1)
-        / (N+1))
+    if sequential:
+        df_summary['P-value'] = p_values
+        df_summary['Replicates'] = replicates
+    else:
+        df_summary['P-value'] = (
+            ((mc_eig_values>=observed_eig_values).sum().values.astype('float') + 1)
+            / (N+1))
         
     return df_summary
 
 #------------------------------------------------------------------------    
 
-def cross_scatter(df_1, df_2, lin_regress=True):
+def _corr_eig_values(data_normalized):
+    """Eigenvalues, largest first, of the correlation matrices of a stack of 
+    normalized data arrays shaped (replicates, rows, columns)
+    """
+
+    n_rows = data_normalized.shape[1]
+    corr_matrices = np.matmul(
+                        data_normalized.transpose(0, 2, 1), data_normalized
+                        ) / (n_rows - 1)
+
+    return np.linalg.eigvalsh(corr_matrices)[:, ::-1]
+
+#------------------------------------------------------------------------    
+
+_MC_BATCH_VALUES = int(1e7)
+_mc_data = None
+
+def _mc_init(data_normalized):
+    global _mc_data
+    _mc_data = data_normalized
+
+def _mc_batch(batch):
+    """Eigenvalues for one batch of column-wise permutations of _mc_data
+    """
+
+    n_replicates, seed = batch
+    n_rows, n_cols = _mc_data.shape
+    rng = np.random.RandomState(seed)
+
+    # one independent permutation of the row indices per replicate and column
+    row_index = np.argsort(rng.random_sample((n_replicates, n_rows, n_cols)), axis=1)
+    permuted = _mc_data[row_index, np.arange(n_cols)]
+
+    return _corr_eig_values(permuted)
+
+def _iter_mc_eig_values(data_normalized, N, batch_size=None, n_jobs=1, random_state=None):
+    """Yield arrays of monte carlo eigenvalues, one batch of replicates at 
+    a time, until N replicates have been produced
+    """
+
+    if batch_size is None:
+        # keep each stack of permuted data to roughly 10 million values
+        batch_size = max(1, _MC_BATCH_VALUES // data_normalized.size)
+
+    batch_sizes = [batch_size] * (N // batch_size)
+    if N % batch_size:
+        batch_sizes.append(N % batch_size)
+    seeds = np.random.RandomState(random_state).randint(
+                                        0, 2**31 - 1, size=len(batch_sizes))
+    batches = zip(batch_sizes, seeds)
+
+    if n_jobs == 1:
+        _mc_init(data_normalized)
+        for batch in batches:
+            yield _mc_batch(batch)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(n_jobs, _mc_init, (data_normalized,))
+    try:
+        for eig_values in pool.imap(_mc_batch, batches):
+            yield eig_values
+    finally:
+        pool.terminate()
+
+#------------------------------------------------------------------------    
+
+def _sequential_mc(observed_eig_values, mc_batches, N, alpha):
+    """Consume batches of monte carlo eigenvalues until the test of every 
+    observed eigenvalue at level alpha is decided. Returns the eigenvalues 
+    drawn, the replicates used per eigenvalue and the p-values
+    """
+
+    # exceedances that rule out a final p-value (k + 1) / (N + 1) <= alpha; 
+    # the tolerance keeps e.g. 0.29 * 100 == 28.999... from losing a count
+    h = int(np.floor(alpha * (N + 1) + 1e-12))
+    if h < 1:
+        mc_batches.close()
+        raise ValueError('alpha must be at least 1 / (N + 1) = %g for a sequential test '
+                         'with N = %d' % (1.0 / (N + 1), N))
+
+    n_cols = len(observed_eig_values)
+    exceedances = np.zeros(n_cols, dtype='int')
+    replicates = np.zeros(n_cols, dtype='int')
+    decided = np.zeros(n_cols, dtype='bool')
+    drawn = []
+    n_drawn = 0
+
+    for eig_values in mc_batches:
+        drawn.append(eig_values)
+        running = exceedances + np.cumsum(eig_values >= observed_eig_values, axis=0)
+        n_running = n_drawn + np.arange(1, len(eig_values) + 1)[:, np.newaxis]
+        stop = (running >= h) | (running + (N - n_running) < h)
+
+        newly_decided = ~decided & stop.any(axis=0)
+        first_stop = stop.argmax(axis=0)[newly_decided]
+        exceedances[newly_decided] = running[first_stop, newly_decided]
+        replicates[newly_decided] = n_running[first_stop, 0]
+        exceedances[~decided & ~newly_decided] = running[-1, ~decided & ~newly_decided]
+        decided |= newly_decided
+
+        n_drawn += len(eig_values)
+        if decided.all():
+            break
+    mc_batches.close()
+
+    stopped_early = (exceedances >= h) & (replicates < N)
+    p_values = np.where(stopped_early, 
+                        exceedances / replicates.astype('float'), 
+                        (exceedances + 1) / (replicates + 1.0))
+
+    return np.concatenate(drawn), replicates, p_values
+
+#------------------------------------------------------------------------    
+
+def pairwise_linregress(df_1, df_2):
+    """Linear regressions of every column of df_2 on every column of df_1, 
+    computed with a few matrix operations. Returns a DataFrame indexed by 
+    (df_1 column, df_2 column) with the slope, intercept, r_value, p_value 
+    and std_err that scipy.stats.linregress would give for each pair; use 
+    e.g. result['r_value'].unstack() for a matrix of one statistic
+    """
+
+    x = np.asarray(df_1, dtype='float')
+    y = np.asarray(df_2, dtype='float')
+    n = x.shape[0]
+
+    x_mean, y_mean = x.mean(axis=0), y.mean(axis=0)
+    x_centered, y_centered = x - x_mean, y - y_mean
+    ssxm = (x_centered**2).mean(axis=0)[:, np.newaxis]
+    ssym = (y_centered**2).mean(axis=0)[np.newaxis, :]
+    ssxym = np.dot(x_centered.T, y_centered) / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        r[(ssxm * ssym) == 0] = 0.0
+
+        dof = n - 2
+        tiny = 1.0e-20
+        t = r * np.sqrt(dof / ((1.0 - r + tiny) * (1.0 + r + tiny)))
+        p_value = 2 * stats.t.sf(np.abs(t), dof)
+
+        slope = ssxym / ssxm
+        intercept = y_mean[np.newaxis, :] - slope * x_mean[:, np.newaxis]
+        std_err = np.sqrt((1 - r**2) * ssym / ssxm / dof)
+
+    index = pd.MultiIndex.from_product([df_1.columns, df_2.columns])
+    
+    return pd.DataFrame(
+            {'slope': slope.ravel(), 'intercept': intercept.ravel(), 
+             'r_value': r.ravel(), 'p_value': p_value.ravel(), 
+             'std_err': std_err.ravel()}, 
+            index=index, 
+            columns=['slope', 'intercept', 'r_value', 'p_value', 'std_err'])
+
+#------------------------------------------------------------------------    
+
+def cross_scatter(df_1, df_2, lin_regress=True, density=None):
     """Takes two DataFrames and builds the scatter plots of all their combinations
+
+    density selects binned rendering of each panel (see scatter); by 
+    default it is used for more than DENSITY_THRESHOLD rows
     """
 
     labels_1 = df_1.columns
@@ -133,18 +953,21 @@ def cross_scatter(df_1, df_2, lin_regress=True):
     fig, ax = plt.subplots(len(labels_2), len(labels_1), figsize=(14,14))
     fig.subplots_adjust(wspace = 0.15, hspace=0.1)
 
+    if lin_regress:
+        regressions = pairwise_linregress(df_1, df_2)
+
     for i, label_1 in enumerate(labels_1):
         for j, label_2 in enumerate(labels_2):
             # scatter plot
-            ax[j,i].scatter(df_1[label_1], df_2[label_2])
+            scatter(ax[j,i], df_1[label_1], df_2[label_2], density=density)
             
             # linear regression and plot
-            slope, intercept, r_value, p_value, std_err = stats.linregress(
-                df_1[label_1], df_2[label_2]
-            )
+            if lin_regress:
+                slope, intercept = regressions.loc[
+                                    (label_1, label_2), ['slope', 'intercept']]
             
-            x = np.linspace(df_1[label_1].min(), df_1[label_1].max())
-            ax[j,i].plot(x, slope*x+intercept, 'r', lw=3)
+                x = np.linspace(df_1[label_1].min(), df_1[label_1].max())
+                ax[j,i].plot(x, slope*x+intercept, 'r', lw=3)
             
             if i != 0:
                 ax[j,i].set_yticklabels([])
@@ -174,14 +997,86 @@ def shuffle_df(df):
 
 #------------------------------------------------------------------------   
 
-def color_scatter_by_df(x, y, df):
+def color_scatter_by_df(x, y, df, density=None, save=None, n_jobs=1):
     """Produce a scatter plot colored by the values in each column 
     of a DataFrame
+
+    density selects binned rendering, coloring each bin by the mean value 
+    of its points (see scatter); by default it is used for more than 
+    DENSITY_THRESHOLD points
+
+    With save set to a file name pattern containing '{column}' (e.g. 
+    'plots/{column}.png') nothing is shown: the scatter is drawn once 
+    off-screen and only its colors are updated before writing each column's 
+    file. n_jobs > 1 splits the columns across worker processes
     """
 
+    if save:
+        column_groups = [group for group in 
+                         np.array_split(np.arange(df.shape[1]), max(1, n_jobs)) 
+                         if len(group)]
+        jobs = [(x, y, df.iloc[:, group], density, save) for group in column_groups]
+
+        if n_jobs == 1:
+            for job in jobs:
+                _save_color_scatters(job)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                pool.map(_save_color_scatters, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return
+
     for column in df.columns:
         plt.figure()
-        plt.scatter(x, y, c=df[column].values)
-        plt.colorbar()
+        artist = scatter(plt.gca(), x, y, c=df[column].values, density=density)
+        plt.colorbar(artist)
         plt.title(column)
         plt.show()
+
+#------------------------------------------------------------------------   
+
+def _save_color_scatters(job):
+    """Write one color_scatter_by_df frame per column, reusing a single 
+    off-screen figure and updating only the color data
+    """
+
+    from matplotlib.image import AxesImage
+
+    x, y, df, density, save = job
+
+    fig = _headless_figure()
+    ax = fig.add_subplot(111)
+    artist = scatter(ax, x, y, c=df.iloc[:, 0].values, density=density)
+    fig.colorbar(artist)
+
+    if isinstance(artist, AxesImage):
+        _, x_edges, y_edges = _density_image(x, y, df.iloc[:, 0].values)
+
+    for column in df.columns:
+        if isinstance(artist, AxesImage):
+            image, _, _ = _density_image(x, y, df[column].values, [x_edges, y_edges])
+            artist.set_data(image)
+        else:
+            artist.set_array(df[column].values)
+        artist.autoscale()
+        ax.set_title(column)
+        fig.savefig(save.format(column=column))
+
+#------------------------------------------------------------------------   
+
+def _headless_figure(**kwargs):
+    """A figure attached to the non-interactive Agg canvas, independent of 
+    pyplot's state and backend, for writing to file
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+
+    return fig
@@ -3,19 +3,41 @@ The fb sub-module of databox contains Facebook-specific functions
 It interacts with the Facebook Graph API 
 """
 
+import array
 import datetime
-import facebook
+import decimal
+import hashlib
+import itertools
 import json
-import matplotlib.pyplot as plt 
 import numpy as np
 import os
 import pandas as pd 
-import urllib2 as ul2
+import random
+import requests
+import sqlite3
+import tempfile
+import threading
+import time
+import urlparse
 import warnings
+import zlib
 
-from geopy.geocoders import Nominatim
-from matplotlib.patches import Polygon
-from mpl_toolkits.basemap import Basemap
+from multiprocessing.pool import ThreadPool
+
+# optional: ijson decodes insight responses incrementally as they download; 
+# prefer its C backend where it was built
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+# plotting, geocoding and map projection are imported on first use
+from .databox import _LazyModule, _headless_figure
+
+plt = _LazyModule('matplotlib.pyplot')
 
 #---------------------------------------------------------------------------------
 
@@ -24,20 +46,210 @@ def string_to_datetime(time_string):
 
 #---------------------------------------------------------------------------------
 
-def get_object(access_token, object_id, fields=None):
+# every Graph API call goes through one pooled keep-alive session; point 
+# GRAPH_URL at a local stub server for testing
+GRAPH_URL = 'https://graph.facebook.com/'
+POOL_SIZE = 32
+TIMEOUT = 60
 
-    if fields:
-        fields_string = '&fields=' + fields
-    else:
-        fields_string = ''
+_session = None
+_session_pid = None
+
+def get_session():
+    """
+    Returns the shared requests.Session used for all Graph API calls. It keeps 
+    up to POOL_SIZE connections alive and asks for gzip-compressed responses. 
+    Each process gets its own, so forked workers never share sockets
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _session = session
+        _session_pid = os.getpid()
+
+    return _session
+
+def graph_get(access_token, path, **params):
+    """
+    GET a Graph API path such as 'v2.5/<object_id>/insights/<metric>'. 
+    Query parameters are url-encoded and those set to None are dropped
+    """
+    params = dict((key, value) for key, value in params.items() if value is not None)
+    params['access_token'] = access_token
+
+    return get_url(GRAPH_URL + path, params)
+
+def get_url(url, params=None):
+    """
+    GET an absolute url (e.g. a paging link from a previous response) 
+    through the shared session and return the decoded JSON
+    """
+    response = get_session().get(url, params=params, timeout=TIMEOUT)
+    response.raise_for_status()
+
+    return response.json()
+
+#---------------------------------------------------------------------------------
+
+# the Graph API accepts at most this many requests per /batch call
+BATCH_LIMIT = 50
+
+def graph_batch(access_token, graph_requests):
+    """
+    Sends many Graph API GET requests as /batch calls of up to BATCH_LIMIT 
+    requests each. graph_requests is a list of (path, params) pairs, with 
+    path and params as for graph_get. Returns the decoded response bodies 
+    in the same order; a failed request gives the Graph error body and a 
+    request the API did not complete gives None
+    """
+    results = []
+    for start in range(0, len(graph_requests), BATCH_LIMIT):
+        batch = [{'method': 'GET', 'relative_url': _relative_url(path, params)} 
+                 for path, params in graph_requests[start:start + BATCH_LIMIT]]
+
+        response = get_session().post(
+            GRAPH_URL, 
+            data={'access_token': access_token, 'batch': json.dumps(batch), 
+                  'include_headers': 'false'}, 
+            timeout=TIMEOUT)
+        response.raise_for_status()
+
+        for item in response.json():
+            results.append(json.loads(item['body']) if item else None)
+
+    return results
 
-    query_url = (
-        'https://graph.facebook.com/v2.6/' + object_id + 
-        '?access_token=' + access_token +
-        fields_string
-        )
+def _relative_url(path, params=None):
+    params = sorted((key, value) for key, value in (params or {}).items() 
+                    if value is not None)
+    if not params:
+        return path
 
-    return json.load(ul2.urlopen(query_url))
+    return path + '?' + requests.compat.urlencode(params)
+
+#---------------------------------------------------------------------------------
+
+# Graph error codes for app, user and page level throttling
+THROTTLE_ERROR_CODES = (4, 17, 32, 613)
+BACKOFF_BASE = 1.0
+
+def fetch_insights(access_token, object_ids, metrics, since=None, until=None, period=None, 
+                   max_concurrency=8, max_retries=5):
+    """
+    Fetches insights for many objects concurrently and yields 
+    (object_id, fb_response) pairs as the responses arrive. All metrics for 
+    an object come from one /insights/m1,m2 request. At most max_concurrency 
+    requests are in flight; the limit shrinks while the X-App-Usage and 
+    X-Page-Usage headers report heavy use and grows back as usage falls. 
+    Throttled and 5xx responses are retried up to max_retries times with 
+    jittered exponential backoff
+    """
+    if isinstance(metrics, (list, tuple)):
+        metrics = ','.join(metrics)
+    params = {'since': since, 'until': until, 'period': period}
+
+    limiter = _AdaptiveLimiter(max_concurrency)
+
+    def fetch(object_id):
+        fb_response = _throttled_get(
+            access_token, 'v2.5/' + object_id + '/insights/' + metrics, params, 
+            limiter, max_retries)
+        return object_id, fb_response
+
+    pool = ThreadPool(max_concurrency)
+    try:
+        for result in pool.imap_unordered(fetch, object_ids):
+            yield result
+    finally:
+        pool.terminate()
+
+def _throttled_get(access_token, path, params, limiter, max_retries):
+    params = dict((key, value) for key, value in params.items() if value is not None)
+    params['access_token'] = access_token
+
+    for attempt in range(max_retries + 1):
+        with limiter:
+            response = get_session().get(GRAPH_URL + path, params=params, timeout=TIMEOUT)
+        limiter.update(_usage_percent(response.headers))
+
+        if not _is_throttled(response) or attempt == max_retries:
+            break
+        # full jitter keeps retrying workers from hitting the API in lockstep
+        time.sleep(random.uniform(0, BACKOFF_BASE * 2**attempt))
+
+    response.raise_for_status()
+
+    return response.json()
+
+def _is_throttled(response):
+    if response.status_code == 429 or response.status_code >= 500:
+        return True
+    if response.status_code >= 400:
+        try:
+            return response.json()['error']['code'] in THROTTLE_ERROR_CODES
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    return False
+
+def _usage_percent(headers):
+    """
+    Highest usage percentage reported in the Graph API usage headers, or 
+    None when the response carries none
+    """
+    usage = []
+    for header in ('X-App-Usage', 'X-Page-Usage'):
+        if header in headers:
+            try:
+                usage.extend(float(value) for value in json.loads(headers[header]).values())
+            except (ValueError, AttributeError, TypeError):
+                pass
+
+    return max(usage) if usage else None
+
+class _AdaptiveLimiter(object):
+    """
+    Context manager admitting at most limit concurrent requests; the limit 
+    adapts to reported API usage between 1 and max_limit
+    """
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def update(self, usage):
+        if usage is None:
+            return
+        with self._condition:
+            if usage >= 90:
+                self.limit = 1
+            elif usage >= 75:
+                self.limit = max(1, self.limit // 2)
+            elif usage < 50:
+                self.limit = min(self.max_limit, self.limit + 1)
+            self._condition.notify_all()
+
+#---------------------------------------------------------------------------------
+
+def get_object(access_token, object_id, fields=None):
+
+    return graph_get(access_token, 'v2.6/' + object_id, fields=fields)
 
 #---------------------------------------------------------------------------------
 
@@ -45,64 +257,497 @@ def introspect(access_token, object_id):
     '''
     Returns a facebook node's available edges (connections) and fields
     '''
-    query_url = (
-        'https://graph.facebook.com/v2.6/' + object_id + 
-        '?access_token=' + access_token + '&metadata=1'
-        )
-
-    return json.load(ul2.urlopen(query_url))
+    return graph_get(access_token, 'v2.6/' + object_id, metadata=1)
 
 #---------------------------------------------------------------------------------
 
-def get_posts(access_token, page_id, limit=10):
+# the Graph API caps edge pages at this many items
+PAGE_LIMIT = 100
 
+def iter_edge(access_token, object_id, edge, fields=None, page_size=PAGE_LIMIT, max_items=None, 
+              **params):
     """
-    Max limit is 100, per Graph API limitations. 
+    Yields the items of an object's edge (e.g. a page's posts or a post's 
+    comments) one at a time, following the cursor paging.next links lazily. 
+    Only the given fields are requested. While one page is being consumed 
+    the next is fetched in the background, so at most two pages are held 
+    in memory. Stops after max_items items, without fetching pages beyond 
+    them. Extra params (e.g. filter, order) are passed on to the 
+    first request and carried through by the paging links
     """
-    
-    query_url = (
-        'https://graph.facebook.com/v2.5/' + page_id + 
-        '?access_token=' + access_token +
-        '&fields=posts.limit(' + str(limit) + ')'
-        )
+    if isinstance(fields, (list, tuple)):
+        fields = ','.join(fields)
+
+    pool = ThreadPool(1)
+    try:
+        fb_response = graph_get(access_token, 'v2.5/' + object_id + '/' + edge, 
+                                fields=fields, limit=min(page_size, PAGE_LIMIT), **params)
+        remaining = max_items
+        while True:
+            data = fb_response.get('data', [])
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+
+            next_url = fb_response.get('paging', {}).get('next')
+            if remaining == 0 or not data:
+                next_url = None
+            next_page = pool.apply_async(get_url, (next_url,)) if next_url else None
+
+            for item in data:
+                yield item
+
+            if next_page is None:
+                break
+            fb_response = next_page.get()
+    finally:
+        pool.terminate()
+
+def iter_posts(access_token, page_id, fields=None, page_size=PAGE_LIMIT, chunksize=None):
+    """
+    Streams a page's full post history, newest first; see iter_edge. With 
+    chunksize, yields DataFrames of up to chunksize posts indexed by id 
+    instead of single posts
+    """
+    posts = iter_edge(access_token, page_id, 'posts', fields, page_size)
+
+    return _edge_chunks(posts, chunksize) if chunksize else posts
 
-    fb_response = json.load(ul2.urlopen(query_url))
-    df = pd.DataFrame.from_dict(fb_response['posts']['data'])
-    df.index = df['id']
-    del df['id']
+def iter_comments(access_token, post_id, fields=None, page_size=PAGE_LIMIT, chunksize=None, 
+                  filter='stream', order='chronological'):
+    """
+    Streams a post's comments; see iter_edge. By default replies are 
+    included (filter='stream') and comments come oldest first. With 
+    chunksize, yields DataFrames of up to chunksize comments indexed by id 
+    instead of single comments
+    """
+    comments = iter_edge(access_token, post_id, 'comments', fields, page_size, 
+                         filter=filter, order=order)
+
+    return _edge_chunks(comments, chunksize) if chunksize else comments
+
+def _edge_chunks(items, chunksize):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if not chunk:
+            break
+        yield _edge_df(chunk)
+
+def _edge_df(items):
+    df = pd.DataFrame.from_records(items)
+    if 'id' in df:
+        df.index = df['id']
+        del df['id']
 
     return df
 
 #---------------------------------------------------------------------------------
 
-def get_comments(access_token, post_id):
-    pass
+def get_posts(access_token, page_id, limit=10, fields=None):
+
+    """
+    DataFrame of a page's latest limit posts (all of them if limit is None), 
+    paging past the Graph API's 100 per request as needed
+    """
+    posts = iter_edge(access_token, page_id, 'posts', fields, page_size=limit or PAGE_LIMIT, 
+                      max_items=limit)
+
+    return _edge_df(list(posts))
+
+#---------------------------------------------------------------------------------
+
+def get_comments(access_token, post_id, limit=None, fields=None):
+    """
+    DataFrame of a post's comments (the first limit of them if given). Use 
+    iter_comments to stream posts with very many comments
+    """
+    comments = iter_edge(access_token, post_id, 'comments', fields, page_size=limit or PAGE_LIMIT, 
+                         max_items=limit, filter='stream', order='chronological')
+
+    return _edge_df(list(comments))
 
 #---------------------------------------------------------------------------------
 
 def get_insight(access_token, object_id, metric='', since=None, until=None, period=None):
+    """
+    Responses are served from the active insight plan when it covers the 
+    request (see InsightPlan), then from the insight cache when one is 
+    enabled (see enable_insight_cache)
+    """
+    plan = _insight_plan
+    if plan is not None:
+        fb_response = plan.lookup(object_id, metric, period, since, until)
+        if fb_response is not None:
+            return fb_response
+
+    cache = _insight_cache
+    if cache is not None:
+        key = (object_id, metric, period, since, until)
+        fb_response = cache.get(key)
+        if fb_response is not None:
+            return fb_response
     
-    if period:
-        period_string = '&period=' + period
-    else:
-        period_string = ''
+    fb_response = graph_get(access_token, 'v2.5/' + object_id + '/insights/' + metric, 
+                            since=since or None, until=until or None, period=period or None)
 
-    if since:
-        since_string = '&since=' + since
-    else:
-        since_string = ''
+    if cache is not None:
+        cache.put(key, fb_response)
 
-    if until:
-        until_string = '&until=' + until
-    else:
-        until_string = ''
-    
-    query_url = (
-        'https://graph.facebook.com/v2.5/' + object_id + '/insights/' + metric +
-        '?access_token=' + access_token + since_string + until_string + period_string
-        )
+    return fb_response
+
+#---------------------------------------------------------------------------------
+
+class _SQLiteStore(object):
+    """
+    Base for the on-disk caches: one SQLite connection and lock per process, 
+    reopened after a fork since SQLite connections must not cross fork() 
+    (render workers inherit the parent's caches)
+    """
+    SCHEMA = None
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        self._pid = os.getpid()
+        self._pid_lock = threading.Lock()
+        self._pid_connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._pid_connection.execute(self.SCHEMA)
+        self._pid_connection.commit()
+
+    @property
+    def _connection(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._pid_connection
+
+    @property
+    def _lock(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._pid_lock
+
+class InsightCache(_SQLiteStore):
+    """
+    On-disk SQLite cache of insight responses keyed by object id, metric, 
+    period, since and until. Insight values for a window that closed at least 
+    closed_after_days ago never change, so those entries never expire; 
+    anything more recent (or without an until date) expires after recent_ttl 
+    seconds. Least recently used entries are evicted once the stored 
+    responses exceed max_bytes. hits and misses count lookups. The 
+    access_token is stripped from stored paging links; pass it again when 
+    following them (e.g. get_url(link, {'access_token': token}))
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS responses ('
+              'key TEXT PRIMARY KEY, body BLOB, size INTEGER, expires REAL, accessed REAL)')
+
+    def __init__(self, path, recent_ttl=3600, max_bytes=256 * 2**20, closed_after_days=2):
+        self.recent_ttl = recent_ttl
+        self.max_bytes = max_bytes
+        self.closed_after_days = closed_after_days
+        self.hits = 0
+        self.misses = 0
+
+        _SQLiteStore.__init__(self, path)
+
+    def get(self, key):
+        key = json.dumps(key)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT body, expires FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._connection.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._connection.commit()
+
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, fb_response):
+        until = key[-1]
+        expires = None if self._is_closed(until) else time.time() + self.recent_ttl
+        body = zlib.compress(json.dumps(_without_token(fb_response)).encode('utf-8'))
+
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', 
+                (json.dumps(key), sqlite3.Binary(body), len(body), expires, time.time()))
+            self._evict()
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._connection.commit()
+
+    def _is_closed(self, until):
+        if not until:
+            return False
+
+        return _insight_date(until) <= (datetime.datetime.utcnow() - 
+                                        datetime.timedelta(days=self.closed_after_days))
+
+    def _evict(self):
+        now = time.time()
+        self._connection.execute(
+            'DELETE FROM responses WHERE expires IS NOT NULL AND expires < ?', (now,))
+
+        total = self._connection.execute('SELECT SUM(size) FROM responses').fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+        for key, size in self._connection.execute(
+                'SELECT key, size FROM responses ORDER BY accessed'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+def _without_token(fb_response):
+    """
+    fb_response with the access_token query parameter removed from its 
+    paging links, so tokens are never written to disk
+    """
+    paging = fb_response.get('paging') if isinstance(fb_response, dict) else None
+    if not paging:
+        return fb_response
+
+    fb_response = dict(fb_response)
+    fb_response['paging'] = dict(
+        (key, _strip_token(link) if isinstance(link, basestring) else link) 
+        for key, link in paging.items())
+
+    return fb_response
+
+def _strip_token(link):
+    url = urlparse.urlparse(link)
+    query = [(name, value) for name, value in urlparse.parse_qsl(url.query, keep_blank_values=True) 
+             if name != 'access_token']
+
+    return url._replace(query=requests.compat.urlencode(query)).geturl()
+
+_insight_cache = None
+
+def enable_insight_cache(path='insight_cache.sqlite', **kwargs):
+    """
+    Turns on the insight cache for get_insight and every helper built on 
+    it. Keyword arguments are passed to InsightCache. Returns the cache
+    """
+    global _insight_cache
+    _insight_cache = InsightCache(path, **kwargs)
+
+    return _insight_cache
+
+def disable_insight_cache():
+    global _insight_cache
+    _insight_cache = None
+
+def _insight_date(value):
+    """
+    A since/until value, given as a date string or a unix timestamp, as a 
+    datetime
+    """
+    try:
+        return string_to_datetime(str(value))
+    except ValueError:
+        return datetime.datetime.utcfromtimestamp(float(value))
+
+#---------------------------------------------------------------------------------
+
+class InsightPlan(object):
+    """
+    Collects the insights a report needs as (object_id, metric, period, since, 
+    until) requests and fetches them with as few /insights/m1,m2 calls as 
+    possible. Requests for the same object and period are fetched together, 
+    with all their metrics, over one since/until window spanning them as 
+    long as that window stays within INSIGHT_WINDOW_DAYS; requests without 
+    a since and until are only merged with identical windows. The merged 
+    calls go through get_insight, up to max_workers at a time.
+
+    result(request) gives each request just its own metrics and values. 
+    Used as a context manager, the plan is executed on entry and get_insight 
+    (and so every helper built on it) answers the requests it covers from 
+    the plan, e.g.
+
+        plan = InsightPlan(access_token)
+        plan.add(page_id, 'page_fans', since='2016-09-24', until='2016-10-02')
+        plan.add(page_id, 'page_fans_city', since='2016-10-01', until='2016-10-02')
+        with plan:
+            get_weekly_fan_change(access_token, page_id, '2016-10-01')
+            get_page_fans_city(access_token, page_id, '2016-10-01')
+
+    makes a single request
+    """
+    def __init__(self, access_token, max_workers=4):
+        self.access_token = access_token
+        self.max_workers = max_workers
+        self.requests = []
+        self.responses = {}
+        self._previous_plan = None
+
+    def add(self, object_id, metric, period=None, since=None, until=None):
+        """
+        Declares a request and returns it, for use with result. metric may 
+        list several metrics separated by commas
+        """
+        request = (object_id, metric, period or None, since or None, until or None)
+        self.requests.append(request)
+
+        return request
+
+    def queries(self):
+        """
+        The merged (object_id, metrics, period, since, until) calls covering 
+        every declared request
+        """
+        groups = {}
+        for object_id, metric, period, since, until in self.requests:
+            groups.setdefault((object_id, period), []).append((since, until, metric.split(',')))
+
+        queries = []
+        for (object_id, period), windows in sorted(groups.items()):
+            unbounded = {}
+            merged = []
+            for since, until, metrics in sorted(windows):
+                if since is None or until is None:
+                    unbounded.setdefault((since, until), []).extend(metrics)
+                elif merged and _span_days(merged[-1][0], until) <= INSIGHT_WINDOW_DAYS:
+                    merged[-1][1] = max(merged[-1][1], until, key=_insight_date)
+                    merged[-1][2].extend(metrics)
+                else:
+                    merged.append([since, until, list(metrics)])
+
+            windows = [(since, until, metrics) for (since, until), metrics in unbounded.items()]
+            for since, until, metrics in sorted(windows) + [tuple(window) for window in merged]:
+                metrics = ','.join(sorted(set(metrics)))
+                queries.append((object_id, metrics, period, since, until))
+
+        return queries
+
+    def execute(self):
+        """
+        Fetches the merged calls not fetched yet; returns the plan
+        """
+        queries = [query for query in self.queries() if query not in self.responses]
+        if not queries:
+            return self
+
+        def fetch(query):
+            object_id, metrics, period, since, until = query
+            return query, get_insight(self.access_token, object_id, metrics, 
+                                      since=since, until=until, period=period)
+
+        pool = ThreadPool(max(1, min(self.max_workers, len(queries))))
+        try:
+            self.responses.update(pool.map(fetch, queries))
+        finally:
+            pool.terminate()
+
+        return self
+
+    def result(self, request):
+        """
+        The response to a declared request, executing the plan if needed
+        """
+        fb_response = self.execute().lookup(*request)
+        if fb_response is None:
+            raise KeyError(request)
+
+        return fb_response
+
+    def lookup(self, object_id, metric, period=None, since=None, until=None):
+        """
+        The response to a request, cut out of a fetched call covering it, 
+        or None when no fetched call does
+        """
+        if not metric:
+            return None
+        metrics = metric.split(',')
+        period, since, until = period or None, since or None, until or None
+
+        for query, fb_response in self.responses.items():
+            query_id, query_metrics, query_period, query_since, query_until = query
+            if (query_id != object_id or query_period != period or 
+                    not set(metrics) <= set(query_metrics.split(','))):
+                continue
+            if None in (since, until, query_since, query_until):
+                if (since, until) == (query_since, query_until):
+                    return _select_insights(fb_response, metrics)
+            elif (_insight_date(query_since) <= _insight_date(since) and 
+                    _insight_date(until) <= _insight_date(query_until)):
+                return _select_insights(fb_response, metrics, since, until)
+
+        return None
+
+    def __enter__(self):
+        global _insight_plan
+        self.execute()
+        self._previous_plan, _insight_plan = _insight_plan, self
+
+        return self
+
+    def __exit__(self, *exc_info):
+        global _insight_plan
+        _insight_plan, self._previous_plan = self._previous_plan, None
+
+_insight_plan = None
+
+def _span_days(since, until):
+    return (_insight_date(until) - _insight_date(since)).days
+
+def _select_insights(fb_response, metrics, since=None, until=None):
+    """
+    The entries of fb_response for the given metrics, in that order, keeping 
+    only values that end after since and no later than until. Without a 
+    window the other top-level keys are kept too, with paging links 
+    rewritten to request just these metrics; with a window they would 
+    describe the merged window, so they are dropped
+    """
+    if since is not None:
+        since, until = _insight_date(since).date(), _insight_date(until).date()
+
+    entries = dict((entry['name'], []) for entry in fb_response['data'])
+    for entry in fb_response['data']:
+        entries[entry['name']].append(entry)
+
+    data = []
+    for metric in metrics:
+        for entry in entries.get(metric, []):
+            entry = dict(entry)
+            if since is not None:
+                entry['values'] = [value for value in entry['values'] 
+                                   if since < string_to_datetime(value['end_time']).date() <= until]
+            data.append(entry)
+
+    selected = dict(fb_response) if since is None else {}
+    selected['data'] = data
+    if isinstance(selected.get('paging'), dict):
+        selected['paging'] = dict(
+            (key, _link_for_metrics(link, metrics) if isinstance(link, basestring) else link) 
+            for key, link in selected['paging'].items())
+
+    return selected
+
+def _link_for_metrics(link, metrics):
+    """
+    A paging link of a merged /insights/m1,m2 call pointed at just metrics
+    """
+    url = urlparse.urlparse(link)
+    head, separator, _ = url.path.rpartition('/insights/')
+    if not separator:
+        return link
 
-    return json.load(ul2.urlopen(query_url))
+    return url._replace(path=head + separator + ','.join(metrics)).geturl()
 
 #---------------------------------------------------------------------------------
 
@@ -150,110 +795,254 @@ def get_positive_feedback_week(access_token, page_id, date):
 
 #---------------------------------------------------------------------------------
 
-def get_story_tellers_by_city(access_token, object_id, date, period='week'):
+class CityValuesBuilder(object):
+    """
+    Decodes per-city insight responses, where 
+    fb_response['data'][0]['values'][j]['value'] is a dict of city -> count, 
+    straight into columns of date codes, city codes and values. Pages can be 
+    added one after another without building intermediate DataFrames; 
+    to_long() and to_wide() build the frame once at the end
+    """
+    def __init__(self):
+        self._date_codes = {}
+        self._city_codes = {}
+        self._dates = array.array('l')
+        self._cities = array.array('l')
+        self._values = array.array('d')
+
+    def add(self, fb_response):
+
+        return self.add_values((entry['end_time'], entry['value']) 
+                               for entry in fb_response['data'][0]['values'])
+
+    def add_values(self, values):
+        """
+        Adds (end_time, city counts) pairs, e.g. streamed by 
+        iter_insight_values
+        """
+        date_codes, city_codes = self._date_codes, self._city_codes
+        for end_time, counts in values:
+            date_code = date_codes.setdefault(end_time[0:10], len(date_codes))
+            self._dates.extend([date_code] * len(counts))
+            self._cities.extend([city_codes.setdefault(city, len(city_codes)) 
+                                 for city in counts])
+            self._values.extend([float(count) for count in counts.values()])
+
+        return self
+
+    def to_long(self):
+        """
+        One row per (date, city) with a categorical city column
+        """
+        dates = self._categories(self._date_codes)
+        cities = self._categories(self._city_codes)
+
+        return pd.DataFrame({
+            'date': pd.to_datetime(dates).take(np.frombuffer(self._dates, dtype='l')), 
+            'city': pd.Categorical.from_codes(np.frombuffer(self._cities, dtype='l'), cities), 
+            'value': np.frombuffer(self._values, dtype='d').copy()
+            }, columns=['date', 'city', 'value'])
+
+    def to_wide(self):
+        """
+        Dates by cities, NaN where a city has no value for a date
+        """
+        dates = self._categories(self._date_codes)
+        cities = self._categories(self._city_codes)
+
+        wide = np.full((len(dates), len(cities)), np.nan)
+        wide[np.frombuffer(self._dates, dtype='l'), 
+             np.frombuffer(self._cities, dtype='l')] = np.frombuffer(self._values, dtype='d')
+
+        return pd.DataFrame(wide, index=pd.to_datetime(dates), columns=cities)
+
+    @staticmethod
+    def _categories(codes):
+        categories = [None] * len(codes)
+        for category, code in codes.items():
+            categories[code] = category
+
+        return categories
+
+def city_counts_to_df(fb_response):
+    """
+    The city -> count dict of the first value in a per-city insight response 
+    as a DataFrame indexed by city with a 'count' column
+    """
+    city_counts = fb_response['data'][0]['values'][0]['value']
+
+    return pd.DataFrame({'count': pd.Series(city_counts, dtype='float')})
+
+#---------------------------------------------------------------------------------
+
+GEOCODE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.databox_geocode.sqlite')
+# city, lat, lon CSV loaded into the geocode cache the first time cities are 
+# located offline; no gazetteer ships with databox, so drop one in here or 
+# point this elsewhere
+GEOCODE_GAZETTEER = os.path.join(os.path.dirname(__file__), 'geodata', 'cities.csv')
+# Nominatim's usage policy allows one request per second
+GEOCODE_DELAY = 1.0
+
+class GeocodeCache(_SQLiteStore):
+    """
+    Persistent SQLite store of city -> (lat, lon), by default at 
+    GEOCODE_CACHE_PATH. Cities that could not be geocoded are stored too 
+    (as NaN) so they are not looked up again
+    """
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS cities (city TEXT PRIMARY KEY, lat REAL, lon REAL)'
+
+    def __init__(self, path=None):
+        self.seeded = False
+        _SQLiteStore.__init__(self, path or GEOCODE_CACHE_PATH)
+
+    def lookup(self, cities, offline=False):
+        """
+        Returns a DataFrame of lat and lon indexed by city. Cities missing from 
+        the store are geocoded in one throttled pass and stored as they are 
+        found, unless offline, in which case they are left as NaN (see 
+        locate_cities for seeding offline lookups from a gazetteer). Cities 
+        whose lookup fails (timeouts, rate limits, network errors) are left 
+        as NaN without being stored, so they are retried next time
+        """
+        cities = list(cities)
+        known = self._select(cities)
+
+        misses = [city for city in pd.unique(cities) if city not in known]
+        if misses and not offline:
+            from geopy.exc import GeopyError
+            from geopy.geocoders import Nominatim
+            geolocator = Nominatim()
+            failed = []
+            for i, city in enumerate(misses):
+                if i:
+                    time.sleep(GEOCODE_DELAY)
+                try:
+                    location = geolocator.geocode(city)
+                except GeopyError:
+                    failed.append(city)
+                    continue
+                if location is None:
+                    row = (city, None, None)
+                else:
+                    row = (city, location.latitude, location.longitude)
+                # stored one by one so a later failure loses nothing
+                self._insert([row])
+                known[city] = row[1:]
+
+            if failed:
+                warnings.warn('Could not geocode %d of %d cities, e.g. %r' 
+                              % (len(failed), len(misses), failed[0]))
+
+        coordinates = [known.get(city, (None, None)) for city in cities]
+
+        return pd.DataFrame(coordinates, index=cities, columns=['lat', 'lon'], dtype='float')
+
+    def seed(self, gazetteer):
+        """
+        Loads a gazetteer CSV file with city, lat and lon columns into the 
+        store, keeping entries that are already present, so that maps can be 
+        drawn offline
+        """
+        df = pd.read_csv(gazetteer, usecols=['city', 'lat', 'lon'])
+        self._insert(df.itertuples(index=False), replace=False)
+        self.seeded = True
+
+    def _select(self, cities):
+        known = {}
+        with self._lock:
+            # stay below SQLite's limit on query parameters
+            for start in range(0, len(cities), 500):
+                chunk = cities[start:start + 500]
+                rows = self._connection.execute(
+                    'SELECT city, lat, lon FROM cities WHERE city IN (%s)' 
+                    % ','.join('?' * len(chunk)), chunk)
+                known.update((city, (lat, lon)) for city, lat, lon in rows)
+
+        return known
+
+    def _insert(self, rows, replace=True):
+        statement = 'INSERT OR %s INTO cities VALUES (?, ?, ?)' % (
+                        'REPLACE' if replace else 'IGNORE')
+        with self._lock:
+            self._connection.executemany(statement, [tuple(row) for row in rows])
+            self._connection.commit()
+
+_geocode_cache = None
+
+def locate_cities(cities, offline=False):
+    """
+    Latitude and longitude of each city, from the shared GeocodeCache at 
+    GEOCODE_CACHE_PATH. The first offline call seeds the cache from the 
+    GEOCODE_GAZETTEER CSV when that file exists, so maps can be drawn on a 
+    machine that has never geocoded
+    """
+    global _geocode_cache
+    if _geocode_cache is None or _geocode_cache.path != GEOCODE_CACHE_PATH:
+        _geocode_cache = GeocodeCache()
+
+    if offline and not _geocode_cache.seeded and os.path.isfile(GEOCODE_GAZETTEER):
+        _geocode_cache.seed(GEOCODE_GAZETTEER)
+
+    return _geocode_cache.lookup(cities, offline=offline)
+
+#---------------------------------------------------------------------------------
+
+def get_story_tellers_by_city(access_token, object_id, date, period='week', offline=False):
     next_date = str(string_to_datetime(date) + datetime.timedelta(days=1))[0:10]
     
     fb_response = get_insight(access_token, object_id, 'page_storytellers_by_city', 
                                           since=date, until=next_date, period=period)
     
     
-    city_counts = fb_response['data'][0]['values'][0]['value']
-    cities_df = pd.DataFrame()
-    geolocator = Nominatim()
+    cities_df = city_counts_to_df(fb_response)
 
-    for city in city_counts:
-        cities_df.loc[city, 'count'] = city_counts[city]
-        location = geolocator.geocode(city)
-        cities_df.loc[city, 'lat'] = location.latitude
-        cities_df.loc[city, 'lon'] = location.longitude
-    
-    return cities_df
+    return cities_df.join(locate_cities(cities_df.index, offline=offline))
 
 #---------------------------------------------------------------------------------
 
-def get_page_fans_city(access_token, object_id, date):
+def get_page_fans_city(access_token, object_id, date, offline=False):
     next_date = str(string_to_datetime(date) + datetime.timedelta(days=1))[0:10]
     
     fb_response = get_insight(access_token, object_id, 'page_fans_city', 
                                           since=date, until=next_date)
     
     
-    city_counts = fb_response['data'][0]['values'][0]['value']
-    cities_df = pd.DataFrame()
-    geolocator = Nominatim()
+    cities_df = city_counts_to_df(fb_response)
 
-    for city in city_counts:
-        cities_df.loc[city, 'count'] = city_counts[city]
-        location = geolocator.geocode(city)
-        cities_df.loc[city, 'lat'] = location.latitude
-        cities_df.loc[city, 'lon'] = location.longitude
-    
-    return cities_df
+    return cities_df.join(locate_cities(cities_df.index, offline=offline))
 #---------------------------------------------------------------------------------
 
-def map_page_fans_city(access_token, object_id, date, markersize=1):
+def map_page_fans_city(access_token, object_id, date, markersize=1, offline=False):
     
-    cities = get_page_fans_city(access_token, object_id, date)
+    cities = get_page_fans_city(access_token, object_id, date, offline=offline)
     
-    plt.figure(figsize=(8,8))
-
-    my_map = Basemap(projection='merc', 
-                     llcrnrlon=-125, llcrnrlat=24,
-                     urcrnrlon=-66, urcrnrlat=51,
-                     resolution='l', area_thresh=1000.0)
-
-    my_map.drawcoastlines()
-    my_map.drawcountries()
-    my_map.drawstates()
-    # my_map.fillcontinents(color='green')
-
-    x,y = my_map(cities.lon.values, cities.lat.values)
-    my_map.scatter(x, y, s=cities['count'].values*markersize)
+    CityMapTemplate(markersize, fig=plt.figure(figsize=(8,8))).update(cities)
 
     plt.show()
 
     return cities
 #---------------------------------------------------------------------------------
 
-def get_page_impressions_by_city_unique(access_token, object_id, date, period='week'):
+def get_page_impressions_by_city_unique(access_token, object_id, date, period='week', offline=False):
     next_date = str(string_to_datetime(date) + datetime.timedelta(days=1))[0:10]
     
     fb_response = get_insight(access_token, object_id, 'page_impressions_by_city_unique', 
                                           since=date, until=next_date, period=period)
     
     
-    city_counts = fb_response['data'][0]['values'][0]['value']
-    cities_df = pd.DataFrame()
-    geolocator = Nominatim()
+    cities_df = city_counts_to_df(fb_response)
 
-    for city in city_counts:
-        cities_df.loc[city, 'count'] = city_counts[city]
-        location = geolocator.geocode(city)
-        cities_df.loc[city, 'lat'] = location.latitude
-        cities_df.loc[city, 'lon'] = location.longitude
-    
-    return cities_df
+    return cities_df.join(locate_cities(cities_df.index, offline=offline))
 
 #---------------------------------------------------------------------------------
 
-def map_page_impressions_by_city_unique(access_token, object_id, date, period='week', markersize=1):
+def map_page_impressions_by_city_unique(access_token, object_id, date, period='week', markersize=1, 
+                                        offline=False):
     
-    cities = get_page_impressions_by_city_unique(access_token, object_id, date, period)
+    cities = get_page_impressions_by_city_unique(access_token, object_id, date, period, 
+                                                 offline=offline)
     
-    plt.figure(figsize=(8,8))
-
-    my_map = Basemap(projection='merc', 
-                     llcrnrlon=-125, llcrnrlat=24,
-                     urcrnrlon=-66, urcrnrlat=51,
-                     resolution='l', area_thresh=1000.0)
-
-    my_map.drawcoastlines()
-    my_map.drawcountries()
-    my_map.drawstates()
-    # my_map.fillcontinents(color='green')
-
-    x,y = my_map(cities.lon.values, cities.lat.values)
-    my_map.scatter(x, y, s=cities['count'].values*markersize)
+    CityMapTemplate(markersize, fig=plt.figure(figsize=(8,8))).update(cities)
 
     plt.show()
 
@@ -261,110 +1050,301 @@ def map_page_impressions_by_city_unique(access_token, object_id, date, period='w
 
 #---------------------------------------------------------------------------------
     
-def map_story_tellers_by_city(access_token, object_id, date, period='week'):
+def map_story_tellers_by_city(access_token, object_id, date, period='week', offline=False):
     
-    cities = get_story_tellers_by_city(access_token, object_id, date, period=period)
+    cities = get_story_tellers_by_city(access_token, object_id, date, period=period, 
+                                       offline=offline)
     
-    plt.figure(figsize=(8,8))
-
-    my_map = Basemap(projection='merc', 
-                     llcrnrlon=-125, llcrnrlat=24,
-                     urcrnrlon=-66, urcrnrlat=51,
-                     resolution='l', area_thresh=1000.0)
-
-    my_map.drawcoastlines()
-    my_map.drawcountries()
-    my_map.drawstates()
-    # my_map.fillcontinents(color='green')
-
-    x,y = my_map(cities.lon.values, cities.lat.values)
-    my_map.scatter(x, y, s=cities['count'].values*8)
+    CityMapTemplate(8, fig=plt.figure(figsize=(8,8))).update(cities)
 
     plt.show()
 
 #---------------------------------------------------------------------------------
 
-def draw_video_view_map(access_token, post_id, save=None):
-    fb_response = get_insight(access_token, post_id, metric='post_video_view_time_by_region_id')
-    df = pd.DataFrame.from_dict(fb_response['data'][0]['values'][0]['value'], orient='index')
-    df.columns = ['view_time']
+class CityMapTemplate(object):
+    """
+    The US city bubble map of map_page_fans_city and friends, with the basemap 
+    layers drawn once. update() only moves and resizes the markers, so many 
+    dates or pages can be rendered to file from one template. Without fig, 
+    the template draws on an off-screen figure
+    """
+    def __init__(self, markersize=1, fig=None):
+        from mpl_toolkits.basemap import Basemap
+
+        self.markersize = markersize
+        self.fig = fig if fig is not None else _headless_figure(figsize=(8,8))
+        self.ax = self.fig.add_subplot(111)
+
+        self.map = Basemap(projection='merc', 
+                           llcrnrlon=-125, llcrnrlat=24,
+                           urcrnrlon=-66, urcrnrlat=51,
+                           resolution='l', area_thresh=1000.0, ax=self.ax)
+
+        self.map.drawcoastlines()
+        self.map.drawcountries()
+        self.map.drawstates()
+
+        self.markers = self.ax.scatter([], [])
+        self.map.set_axes_limits(ax=self.ax)
+
+    def update(self, cities, save=None):
+        """
+        Shows the cities DataFrame (count, lat and lon columns) and writes 
+        the figure to save if given
+        """
+        x, y = self.map(cities.lon.values, cities.lat.values)
+        self.markers.set_offsets(np.column_stack([x, y]))
+        self.markers.set_sizes(cities['count'].values * self.markersize)
+
+        if save:
+            self.fig.savefig(save)
+
+# the city helpers render_city_maps can draw
+CITY_MAP_METRICS = {
+    'page_fans_city': lambda access_token, object_id, date, period, offline: 
+        get_page_fans_city(access_token, object_id, date, offline=offline),
+    'page_impressions_by_city_unique': lambda access_token, object_id, date, period, offline: 
+        get_page_impressions_by_city_unique(access_token, object_id, date, period, offline=offline),
+    'page_storytellers_by_city': lambda access_token, object_id, date, period, offline: 
+        get_story_tellers_by_city(access_token, object_id, date, period, offline=offline),
+    }
+
+def render_city_maps(access_token, object_ids, dates, save, metric='page_fans_city', 
+                     period='week', markersize=1, offline=False, n_jobs=1):
+    """
+    Renders a city map file for every combination of object_ids and dates 
+    (either may be a single value). save is a file name pattern that may use 
+    {object_id}, {date} and {metric}. Each worker process draws the basemap 
+    once and renders its share of the maps by updating the markers
+    """
+    jobs = [(object_id, date) for object_id in _as_list(object_ids) for date in _as_list(dates)]
+    settings = (access_token, save, metric, period, markersize, offline)
 
-    cmap = plt.get_cmap('Blues')
-    this_dir, this_file = os.path.split(__file__)
+    _run_render_jobs(_render_city_maps, settings, jobs, n_jobs)
 
-    def remove_suffix(string):
-        return string[0:-16]
+def _render_city_maps(args):
+    (access_token, save, metric, period, markersize, offline), jobs = args
 
-    df.index = df.index.map(remove_suffix)
-    df['view_time_normalized'] = df['view_time'].values / float(df['view_time'].max())
-    df['view_time'] = df['view_time'].values / 60000.0
-    fig = plt.figure(figsize=(20,10))
+    template = CityMapTemplate(markersize)
+    for object_id, date in jobs:
+        cities = CITY_MAP_METRICS[metric](access_token, object_id, date, period, offline)
+        template.update(cities, save.format(object_id=object_id, date=date, metric=metric))
 
-    ax1 = plt.subplot2grid((2,3), (0,0))
-    map1 = Basemap(llcrnrlon=-179.15,llcrnrlat=51.21,urcrnrlon=-129.98,urcrnrlat=71.44,
-            projection='merc')
-    map1.readshapefile(this_dir + '/geodata/cb_2015_us_state_20m', name='states', drawbounds=True)
-    map1.drawmapboundary(fill_color='lightgray')
+def _as_list(values):
+    return list(values) if isinstance(values, (list, tuple, np.ndarray, pd.Index)) else [values]
 
-    ax2 = plt.subplot2grid((2,3), (1,0))
-    map2 = Basemap(llcrnrlon=-160.25, llcrnrlat=18.91, urcrnrlon=-154.81, urcrnrlat=22.24,
-            projection='merc')
-    map2.readshapefile(this_dir + '/geodata/cb_2015_us_state_20m', name='states', drawbounds=True)
-    map2.drawmapboundary(fill_color='lightgray')
+def _run_render_jobs(render, settings, jobs, n_jobs=1):
+    """
+    Splits jobs into n_jobs contiguous shares and runs render((settings, share)) 
+    on each, in worker processes when n_jobs > 1
+    """
+    shares = [share for share in np.array_split(np.arange(len(jobs)), max(1, n_jobs)) 
+              if len(share)]
+    work = [(settings, [jobs[i] for i in share]) for share in shares]
+
+    if n_jobs == 1:
+        for args in work:
+            render(args)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        pool.map(render, work)
+    finally:
+        pool.close()
+        pool.join()
 
-    ax3 = plt.subplot2grid((2,3), (0,1), rowspan=2)
-    map3 = Basemap(llcrnrlon=-119,llcrnrlat=22,urcrnrlon=-64,urcrnrlat=49,
-            projection='lcc',lat_1=33,lat_2=45,lon_0=-95)
-    map3.readshapefile(this_dir + '/geodata/cb_2015_us_state_20m', name='states', drawbounds=True)
-    map3.drawmapboundary(fill_color='lightgray')
+#---------------------------------------------------------------------------------
 
-    ax4 = plt.subplot2grid((2,3), (0,2), rowspan=2)
-    ax4.imshow(np.array([np.linspace(0,1)]), cmap=cmap, origin='lower', aspect=8)
-    
-    ax1.set_position([0.00, 0.50, 0.25, 0.40])
-    ax2.set_position([0.00, 0.05, 0.25, 0.30])
-    ax3.set_position([0.15, 0.00, 1.00, 1.00])
-    ax4.set_position([0.3, 0.05, 0.2, 0.1])
+# Basemap settings for the three panels of draw_video_view_map
+STATE_MAP_PROJECTIONS = {
+    'alaska': dict(llcrnrlon=-179.15, llcrnrlat=51.21, urcrnrlon=-129.98, urcrnrlat=71.44, 
+                   projection='merc'),
+    'hawaii': dict(llcrnrlon=-160.25, llcrnrlat=18.91, urcrnrlon=-154.81, urcrnrlat=22.24, 
+                   projection='merc'),
+    'contiguous': dict(llcrnrlon=-119, llcrnrlat=22, urcrnrlon=-64, urcrnrlat=49, 
+                       projection='lcc', lat_1=33, lat_2=45, lon_0=-95),
+    }
+STATE_SHAPES_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.databox_state_shapes')
 
-    ax4.set_yticks([])
-    ax4.set_xticks([0,49])
-    ax4.set_xticklabels([str(0), str(df.view_time.max())[0:3]])
-    ax4.tick_params(axis='both', which='both', length=0, labelsize=16)
+_state_shapes = {}
 
+def get_state_shapes(projection):
+    """
+    Returns the cb_2015_us_state_20m state polygons projected for one of 
+    STATE_MAP_PROJECTIONS as a dict with 'shapes' (a list of (n, 2) arrays of 
+    map coordinates), 'index' (state name -> list of shape positions) and 
+    'extent' (llcrnrx, llcrnry, urcrnrx, urcrnry). The shapefile is parsed and 
+    projected once; results are kept in memory and as .npz files in 
+    STATE_SHAPES_CACHE_DIR
+    """
+    if projection in _state_shapes:
+        return _state_shapes[projection]
+
+    settings = STATE_MAP_PROJECTIONS[projection]
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[0:12]
+    cache_path = os.path.join(STATE_SHAPES_CACHE_DIR, projection + '_' + key + '.npz')
+
+    if os.path.isfile(cache_path):
+        with np.load(cache_path) as cached:
+            shapes = np.split(cached['coordinates'], cached['offsets'][1:-1])
+            names = list(cached['names'])
+            extent = tuple(cached['extent'])
+    else:
+        from mpl_toolkits.basemap import Basemap
+
+        this_dir, this_file = os.path.split(__file__)
+        state_map = Basemap(**settings)
+        state_map.readshapefile(this_dir + '/geodata/cb_2015_us_state_20m', name='states', 
+                                drawbounds=False)
+        shapes = [np.array(shape, dtype='float') for shape in state_map.states]
+        names = [shape_dict['NAME'] for shape_dict in state_map.states_info]
+        extent = (state_map.llcrnrx, state_map.llcrnry, state_map.urcrnrx, state_map.urcrnry)
+
+        try:
+            os.makedirs(STATE_SHAPES_CACHE_DIR)
+        except OSError:
+            if not os.path.isdir(STATE_SHAPES_CACHE_DIR):
+                raise
+        # render workers may fill the cache concurrently, so the file only 
+        # appears at cache_path once it is complete
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=STATE_SHAPES_CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, 
+                         coordinates=np.concatenate(shapes), 
+                         offsets=np.cumsum([0] + [len(shape) for shape in shapes]), 
+                         names=np.array(names), extent=np.array(extent))
+            os.rename(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    index = {}
+    for i, name in enumerate(names):
+        index.setdefault(name, []).append(i)
+
+    _state_shapes[projection] = {'shapes': shapes, 'index': index, 'extent': extent}
+
+    return _state_shapes[projection]
+
+def _draw_state_map(ax, state_shapes, fill_color='lightgray'):
+    """
+    Draws state boundaries and the map background on ax the way 
+    Basemap.readshapefile(drawbounds=True) and drawmapboundary would
+    """
+    from matplotlib.collections import LineCollection
+
+    bounds = LineCollection(state_shapes['shapes'], antialiaseds=(1,))
+    bounds.set_color('k')
+    bounds.set_linewidth(0.5)
+    bounds.set_label('_nolabel_')
+    ax.add_collection(bounds)
+
+    llcrnrx, llcrnry, urcrnrx, urcrnry = state_shapes['extent']
+    ax.patch.set_facecolor(fill_color)
+    ax.set_xlim(llcrnrx, urcrnrx)
+    ax.set_ylim(llcrnry, urcrnry)
+    ax.set_aspect('equal', adjustable='box', anchor='C')
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+class VideoViewMapTemplate(object):
+    """
+    The three-panel US state map of draw_video_view_map with boundaries, 
+    backgrounds and the color scale drawn once. All state polygons of each 
+    panel are kept in one PatchCollection, so update() only recolors them. 
+    Without fig, the template draws on an off-screen figure
+    """
+    def __init__(self, fig=None):
+        from matplotlib.collections import PatchCollection
+        from matplotlib.patches import Polygon
+
+        self.fig = fig if fig is not None else _headless_figure(figsize=(20,10))
+        self.cmap = plt.get_cmap('Blues')
+
+        ax1 = self.fig.add_axes([0.00, 0.50, 0.25, 0.40])
+        ax2 = self.fig.add_axes([0.00, 0.05, 0.25, 0.30])
+        ax3 = self.fig.add_axes([0.15, 0.00, 1.00, 1.00])
+        ax4 = self.fig.add_axes([0.3, 0.05, 0.2, 0.1])
+
+        self.panels = []
+        for ax, projection in [(ax1, 'alaska'), (ax2, 'hawaii'), (ax3, 'contiguous')]:
+            state_shapes = get_state_shapes(projection)
+            _draw_state_map(ax, state_shapes)
+            states = PatchCollection([Polygon(shape) for shape in state_shapes['shapes']], 
+                                     facecolors='none', edgecolors='none')
+            ax.add_collection(states)
+            self.panels.append((states, state_shapes))
+
+        ax4.imshow(np.array([np.linspace(0,1)]), cmap=self.cmap, origin='lower', aspect=8)
+        ax4.set_yticks([])
+        ax4.set_xticks([0,49])
+        ax4.tick_params(axis='both', which='both', length=0, labelsize=16)
+        self.scale_ax = ax4
+
+        self.fig.set_facecolor('lightgray')
+
+    def update(self, view_time, save=None):
+        """
+        Colors the states by view_time, a Series of milliseconds viewed 
+        indexed by state name, and writes the figure to save if given
+        """
+        view_time_normalized = view_time / float(view_time.max())
+        view_time = view_time / 60000.0
+
+        self.scale_ax.set_xticklabels([str(0), str(view_time.max())[0:3]])
+
+        for states, state_shapes in self.panels:
+            facecolors = np.zeros((len(state_shapes['shapes']), 4))
+            edgecolors = np.zeros((len(state_shapes['shapes']), 4))
+            for state in view_time.index:
+                for state_index in state_shapes['index'].get(state, []):
+                    facecolors[state_index] = self.cmap(view_time_normalized[state])
+                    edgecolors[state_index] = self.cmap(view_time[state])
+            states.set_facecolors(facecolors)
+            states.set_edgecolors(edgecolors)
+
+        if save:
+            self.fig.savefig(save, facecolor=self.fig.get_facecolor(), edge_color='none', 
+                             bbox_inches='tight')
+
+def get_video_view_time_by_state(access_token, post_id):
+    """
+    Milliseconds of video viewed per US state for a post
+    """
+    fb_response = get_insight(access_token, post_id, metric='post_video_view_time_by_region_id')
+    view_time = pd.Series(fb_response['data'][0]['values'][0]['value'], dtype='float')
 
-    # collect the state names from the shapefile attributes so we can
-    # look up the shape obect for a state by its name
-    state_names = []
-    for shape_dict in map1.states_info:
-        state_names.append(shape_dict['NAME'])
+    # region names end in ' (United States)'
+    view_time.index = [region[0:-16] for region in view_time.index]
 
-    # get each state and draw the filled polygon
-    for state in df.index:
-        state_indices = [i for i, x in enumerate(state_names) if x == state]
-        for state_index in state_indices:
+    return view_time
 
-            seg = map1.states[state_index]
-            poly = Polygon(seg, facecolor=cmap(df.loc[state, 'view_time_normalized']) ,edgecolor=cmap(df.loc[state, 'view_time']))
-            ax1.add_patch(poly) 
+def draw_video_view_map(access_token, post_id, save=None):
+    view_time = get_video_view_time_by_state(access_token, post_id)
 
-            seg = map2.states[state_index]
-            poly = Polygon(seg, facecolor=cmap(df.loc[state, 'view_time_normalized']) ,edgecolor=cmap(df.loc[state, 'view_time']))
-            ax2.add_patch(poly) 
+    template = VideoViewMapTemplate(plt.figure(figsize=(20,10)))
+    template.update(view_time, save)
 
-            seg = map3.states[state_index]
-            poly = Polygon(seg, facecolor=cmap(df.loc[state, 'view_time_normalized']) ,edgecolor=cmap(df.loc[state, 'view_time']))
-            ax3.add_patch(poly) 
+    plt.show()
 
-    # fig.subplots_adjust(right=0.8)
-    # cbar_ax = fig.add_axes([0.85, 0.15, 0.05, 0.7])
-    # fig.colorbar(ax3, cax=cbar_ax)
+def render_video_view_maps(access_token, post_ids, save, n_jobs=1):
+    """
+    Writes a video view map for every post. save is a file name pattern 
+    using {post_id}. Each worker process draws the static map once and 
+    renders its share of the posts by recoloring the states
+    """
+    _run_render_jobs(_render_video_view_maps, (access_token, save), list(post_ids), n_jobs)
 
-    fig.set_facecolor('lightgray')
+def _render_video_view_maps(args):
+    (access_token, save), post_ids = args
 
-    if save:
-    	fig.savefig(save, facecolor=fig.get_facecolor(), edge_color='none', bbox_inches='tight')
-
-    plt.show()
+    template = VideoViewMapTemplate()
+    for post_id in post_ids:
+        view_time = get_video_view_time_by_state(access_token, post_id)
+        template.update(view_time, save.format(post_id=post_id))
 
 #---------------------------------------------------------------------------------
 
@@ -387,12 +1367,20 @@ def plot_video_retention(access_token, post_id):
 
 #---------------------------------------------------------------------------------
 
+# one fields= expansion covering everything in a video post summary
+VIDEO_POST_SUMMARY_FIELDS = (
+    'insights.metric(post_video_views).period(lifetime),shares,'
+    'likes.limit(1).summary(true),reactions.limit(1).summary(true),'
+    'comments.limit(1).summary(true)'
+    )
+
 def get_video_post_summary(access_token, post_id):
-    video_view_count = get_insight(access_token, post_id, metric='post_video_views', period='lifetime')['data'][0]['values'][0]['value']
-    share_count = get_object(access_token, post_id, fields='shares')['shares']['count']
-    like_count = get_object(access_token, post_id, fields='likes.limit(1).summary(true)')['likes']['summary']['total_count']
-    reaction_count = get_object(access_token, post_id, fields='reactions.limit(1).summary(true)')['reactions']['summary']['total_count']
-    comment_count = get_object(access_token, post_id, fields='comments.limit(1).summary(true)')['comments']['summary']['total_count']
+    fb_response = get_object(access_token, post_id, fields=VIDEO_POST_SUMMARY_FIELDS)
+    summary = _video_post_summary(fb_response)
+    video_view_count = summary['video_views']
+    share_count = summary['shares']
+    reaction_count = summary['reactions']
+    comment_count = summary['comments']
 
     print "The Injury Prevention video has been viewed " + str(video_view_count) + " times,"
     print "shared " + str(share_count) + " times,"
@@ -401,30 +1389,172 @@ def get_video_post_summary(access_token, post_id):
 
 #---------------------------------------------------------------------------------
 
-def plot_video_view_time_age_gender(access_token, post_id):
-    fb_response = get_insight(access_token, post_id, metric='post_video_view_time_by_age_bucket_and_gender')
-    gender_age = fb_response['data'][0]['values'][0]['value']
+def get_video_post_summaries(access_token, post_ids):
+    """
+    Returns a DataFrame of video views, shares, likes, reactions and comments 
+    indexed by post id. Each post is a single fields= request and the 
+    requests are sent BATCH_LIMIT at a time, so 500 posts take 10 calls
+    """
+    post_ids = list(post_ids)
+    fb_responses = graph_batch(
+        access_token, 
+        [('v2.6/' + post_id, {'fields': VIDEO_POST_SUMMARY_FIELDS}) for post_id in post_ids])
 
-    for demo in gender_age:
-        gender_age[demo] = float(gender_age[demo])/60000
-        
+    summaries = [_video_post_summary(fb_response) for fb_response in fb_responses]
+
+    return pd.DataFrame(summaries, index=post_ids, 
+                        columns=['video_views', 'shares', 'likes', 'reactions', 'comments'])
+
+def _video_post_summary(fb_response):
+    if not fb_response or 'error' in fb_response:
+        return {}
+
+    def total_count(edge):
+        return fb_response.get(edge, {}).get('summary', {}).get('total_count', 0)
+
+    insights = fb_response.get('insights', {}).get('data', [])
+
+    return {
+        'video_views': insights[0]['values'][0]['value'] if insights else np.nan,
+        # posts that were never shared have no shares field
+        'shares': fb_response.get('shares', {}).get('count', 0),
+        'likes': total_count('likes'),
+        'reactions': total_count('reactions'),
+        'comments': total_count('comments'),
+        }
+
+#---------------------------------------------------------------------------------
+
+# Graph API age/gender buckets are keyed 'M.25-34'; buckets outside these 
+# are appended after them in sorted order
+GENDERS = ('M', 'F', 'U')
+AGE_BUCKETS = ('13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+')
+
+class DemographicCube(object):
+    """
+    Age/gender insight values of many objects as one dense array. values 
+    has shape (len(objects), len(genders), len(ages)); buckets an object 
+    did not report are 0 and objects without any value are NaN throughout. 
+    objects, genders and ages label the axes
+    """
+    def __init__(self, values, objects, genders, ages):
+        self.values = values
+        self.objects = list(objects)
+        self.genders = list(genders)
+        self.ages = list(ages)
+
+    @classmethod
+    def from_responses(cls, responses, scale=1):
+        """
+        Builds the cube from (object_id, fb_response) pairs, taking the first 
+        value of each response's first entry and dividing it by scale
+        """
+        objects, buckets = [], []
+        for object_id, fb_response in responses:
+            try:
+                gender_age = fb_response['data'][0]['values'][0]['value'] or {}
+            except (KeyError, IndexError, TypeError):
+                gender_age = None
+            objects.append(object_id)
+            buckets.append(gender_age)
+
+        keys = set(key for gender_age in buckets if gender_age for key in gender_age)
+        split = dict((key, _split_bucket(key)) for key in keys)
+        genders = _bucket_labels(GENDERS, [gender for gender, age in split.values()])
+        ages = _bucket_labels(AGE_BUCKETS, [age for gender, age in split.values()])
+        gender_index = dict((gender, i) for i, gender in enumerate(genders))
+        age_index = dict((age, i) for i, age in enumerate(ages))
+
+        values = np.zeros((len(objects), len(genders), len(ages)))
+        for i, gender_age in enumerate(buckets):
+            if gender_age is None:
+                values[i] = np.nan
+                continue
+            for key, value in gender_age.items():
+                gender, age = split[key]
+                values[i, gender_index[gender], age_index[age]] = value
+
+        return cls(values / scale, objects, genders, ages)
+
+    def gender(self, gender):
+        """
+        objects x ages values for one gender
+        """
+        return self.values[:, self.genders.index(gender), :]
+
+    def totals(self):
+        """
+        Sum over all buckets, per object (NaN for objects without values)
+        """
+        return self.values.sum(axis=(1, 2))
+
+    def normalized(self):
+        """
+        The cube with each object's buckets scaled to sum to 1
+        """
+        totals = self.totals()[:, np.newaxis, np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = self.values / totals
+
+        return DemographicCube(values, self.objects, self.genders, self.ages)
+
+    def to_df(self):
+        """
+        DataFrame indexed by object with (gender, age) columns
+        """
+        columns = pd.MultiIndex.from_product([self.genders, self.ages], names=['gender', 'age'])
+
+        return pd.DataFrame(self.values.reshape(len(self.objects), -1), 
+                            index=pd.Index(self.objects, name='id'), columns=columns)
+
+def _split_bucket(key):
+    gender, _, age = key.partition('.')
+    if not age:
+        gender, age = 'U', key
+
+    return gender, age
+
+def _bucket_labels(known, found):
+    return list(known) + sorted(set(found) - set(known))
+
+def get_demographic_cube(access_token, object_ids, metric, since=None, until=None, period=None, 
+                         scale=1, max_concurrency=8):
+    """
+    Fetches an age/gender metric (e.g. page_fans_gender_age or 
+    post_video_view_time_by_age_bucket_and_gender) for many posts or pages 
+    concurrently via fetch_insights and returns it as a DemographicCube with 
+    objects in the given order
+    """
+    object_ids = list(object_ids)
+    responses = dict(fetch_insights(access_token, object_ids, metric, since, until, period, 
+                                    max_concurrency))
+
+    return DemographicCube.from_responses(
+        [(object_id, responses[object_id]) for object_id in object_ids], scale)
+
+def _plot_age_gender(cube, ylabel):
     width = 0.5
-    ind = np.arange(7)+(1-width)/2
-    ticks = np.arange(7) + 0.5
-    tick_labels = ('13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+')
+    ind = np.arange(len(AGE_BUCKETS))+(1-width)/2
+    ticks = np.arange(len(AGE_BUCKETS)) + 0.5
     
-    men = [gender_age['M.13-17'], gender_age['M.18-24'], gender_age['M.25-34'], gender_age['M.35-44'], 
-          gender_age['M.45-54'], gender_age['M.55-64'], gender_age['M.65+']]
-    
-    women = [gender_age['F.13-17'], gender_age['F.18-24'], gender_age['F.25-34'], gender_age['F.35-44'], 
-          gender_age['F.45-54'], gender_age['F.55-64'], gender_age['F.65+']]
+    men = cube.gender('M')[0, :len(AGE_BUCKETS)]
+    women = cube.gender('F')[0, :len(AGE_BUCKETS)]
     
     p1 = plt.bar(ind, men, width)
     p2 = plt.bar(ind, women, width, bottom=men, color='pink')
-    plt.xticks(ticks, tick_labels)
+    plt.xticks(ticks, AGE_BUCKETS)
     plt.legend((p1[0], p2[0]), ('Men', 'Women'), loc=2)
     plt.xlabel('Age group')
-    plt.ylabel('Total viewing time (minutes)')
+    plt.ylabel(ylabel)
+
+#---------------------------------------------------------------------------------
+
+def plot_video_view_time_age_gender(access_token, post_id):
+    fb_response = get_insight(access_token, post_id, metric='post_video_view_time_by_age_bucket_and_gender')
+    # view time is reported in milliseconds
+    cube = DemographicCube.from_responses([(post_id, fb_response)], scale=60000.)
+
+    _plot_age_gender(cube, 'Total viewing time (minutes)')
     
     return
 
@@ -432,25 +1562,9 @@ def plot_video_view_time_age_gender(access_token, post_id):
 
 def plot_page_fans_age_gender(access_token, page_id):
     fb_response = get_insight(access_token, page_id, metric='page_fans_gender_age')
-    gender_age = fb_response['data'][0]['values'][0]['value']
-        
-    width = 0.5
-    ind = np.arange(7)+(1-width)/2
-    ticks = np.arange(7) + 0.5
-    tick_labels = ('13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+')
-    
-    men = [gender_age['M.13-17'], gender_age['M.18-24'], gender_age['M.25-34'], gender_age['M.35-44'], 
-          gender_age['M.45-54'], gender_age['M.55-64'], gender_age['M.65+']]
-    
-    women = [gender_age['F.13-17'], gender_age['F.18-24'], gender_age['F.25-34'], gender_age['F.35-44'], 
-          gender_age['F.45-54'], gender_age['F.55-64'], gender_age['F.65+']]
-    
-    p1 = plt.bar(ind, men, width)
-    p2 = plt.bar(ind, women, width, bottom=men, color='pink')
-    plt.xticks(ticks, tick_labels)
-    plt.legend((p1[0], p2[0]), ('Men', 'Women'), loc=2)
-    plt.xlabel('Age group')
-    plt.ylabel('Number of fans')
+    cube = DemographicCube.from_responses([(page_id, fb_response)])
+
+    _plot_age_gender(cube, 'Number of fans')
     
     return
 
@@ -460,25 +1574,9 @@ def plot_page_impressions_by_age_gender_unique(access_token, page_id, date, peri
     next_date = str(string_to_datetime(date) + datetime.timedelta(days=1))[0:10]
     fb_response = get_insight(access_token, page_id, metric='page_impressions_by_age_gender_unique',
     							since=date, until=next_date, period=period)
-    gender_age = fb_response['data'][0]['values'][0]['value']
-        
-    width = 0.5
-    ind = np.arange(7)+(1-width)/2
-    ticks = np.arange(7) + 0.5
-    tick_labels = ('13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+')
-    
-    men = [gender_age['M.13-17'], gender_age['M.18-24'], gender_age['M.25-34'], gender_age['M.35-44'], 
-          gender_age['M.45-54'], gender_age['M.55-64'], gender_age['M.65+']]
-    
-    women = [gender_age['F.13-17'], gender_age['F.18-24'], gender_age['F.25-34'], gender_age['F.35-44'], 
-          gender_age['F.45-54'], gender_age['F.55-64'], gender_age['F.65+']]
-    
-    p1 = plt.bar(ind, men, width)
-    p2 = plt.bar(ind, women, width, bottom=men, color='pink')
-    plt.xticks(ticks, tick_labels)
-    plt.legend((p1[0], p2[0]), ('Men', 'Women'), loc=2)
-    plt.xlabel('Age group')
-    plt.ylabel('Number of impressions')
+    cube = DemographicCube.from_responses([(page_id, fb_response)])
+
+    _plot_age_gender(cube, 'Number of impressions')
     
     return
 
@@ -490,103 +1588,437 @@ def plot_page_impressions_by_age_gender_unique(access_token, page_id, date, peri
 
 def get_insight_date_range(
                             graph, object_id, insights=['page_impressions'], 
-                            date_range=['2016-09-14', '2016-10-05'], period='day'
+                            date_range=['2016-09-14', '2016-10-05'], period='day', 
+                            max_workers=4
                             ):
     """
     Works for insights where relevant data are structured as fb_response['data'][i]['values'][j]['value']
     page_video_views being an example
+
+    graph is an access token. The date range is split into since/until windows 
+    of at most INSIGHT_WINDOW_DAYS, each window requests all insights at once 
+    (/insights/m1,m2,...) and the windows are fetched concurrently by up to 
+    max_workers threads, then assembled with a single concatenation
     """
     
+    windows = list(iter_insight_date_range(graph, object_id, insights, date_range, 
+                                           period, max_workers))
+    if not windows:
+        return pd.DataFrame(columns=insights)
+
+    df = pd.concat(windows).sort_index()
     
-    def extract_period(fb_response, period='day'):
-        for datum in fb_response['data']:
-            if datum['period'] == period:
-                return datum            
+    return df[[insight for insight in insights if insight in df.columns]]
+
+#---------------------------------------------------------------------------------
+
+# longest since/until span the Graph API accepts for insights
+INSIGHT_WINDOW_DAYS = 90
+
+def iter_insight_date_range(
+                            access_token, object_id, insights=['page_impressions'], 
+                            date_range=['2016-09-14', '2016-10-05'], period='day', 
+                            max_workers=4
+                            ):
+    """
+    Generator version of get_insight_date_range, yielding one DataFrame 
+    (dates by insights) per since/until window as the windows arrive, in no 
+    particular order
+    """
     
-    def insight_to_df(fb_response):
-        daily_data = extract_period(fb_response)
-        df = pd.DataFrame(daily_data['values']) 
-        df['end_time'] = df['end_time'].map(string_to_datetime)
-        df['end_time'] = df['end_time'].values - np.timedelta64(1,'D')
-        df.columns = ['date', insight]
-        df.index = df['date']
-        del df['date']
-        return df
-        
     from_date, to_date = string_to_datetime(date_range[0]), string_to_datetime(date_range[1])
-    
-    df = pd.DataFrame()
-    for insight in insights:
-        # grab initial daily data, convert to dataframe, convert strings to datetime
-        current_fb_response = get_insight(graph, object_id, insight)
+    metrics = ','.join(insights)
+    windows = _insight_windows(from_date, to_date)
+
+    def fetch(window):
+        values = iter_insight_values(access_token, object_id, metrics, 
+                                     since=window[0], until=window[1], period=period)
+        df = InsightColumnsBuilder(period).add(values).to_df()
+        return df[(df.index >= from_date) & (df.index <= to_date)]
+
+    pool = ThreadPool(max(1, min(max_workers, len(windows))))
+    try:
+        for df in pool.imap_unordered(fetch, windows):
+            yield df
+    finally:
+        pool.terminate()
+
+def _insight_windows(from_date, to_date):
+    """
+    since/until pairs of at most INSIGHT_WINDOW_DAYS covering the dates 
+    from_date .. to_date
+    """
+    # values are stamped with the end of their day, so a window from since 
+    # to until covers the dates since .. until - 1
+    windows = []
+    window_start = from_date
+    while window_start <= to_date:
+        window_end = min(window_start + datetime.timedelta(days=INSIGHT_WINDOW_DAYS), 
+                         to_date + datetime.timedelta(days=1))
+        windows.append((str(window_start)[0:10], str(window_end)[0:10]))
+        window_start = window_end
+
+    return windows
 
-        temp_df = insight_to_df(current_fb_response)
+#---------------------------------------------------------------------------------
 
-        while from_date < temp_df.index.min():
-            previous_page = current_fb_response['paging']['previous']
-            current_fb_response = json.load(ul2.urlopen(previous_page))
-            temp_df = insight_to_df(current_fb_response)
+def iter_insight_values(access_token, object_id, metric='', since=None, until=None, period=None, 
+                        paging=None):
+    """
+    Streams an insights response, yielding (name, period, end_time, value) 
+    for each fb_response['data'][i]['values'][j] entry without building the 
+    nested response. With ijson installed the body is decoded as it 
+    downloads; without it the body is decoded in one go. When an insight 
+    plan or cache is active the request goes through get_insight instead. 
+    A paging dict, if given, receives the response's previous/next links, 
+    which iter_url_values can follow
+    """
+    if _insight_plan is not None or _insight_cache is not None:
+        fb_response = get_insight(access_token, object_id, metric, since, until, period)
+        if paging is not None:
+            paging.update(fb_response.get('paging', {}))
+        for item in _walk_insight_values(fb_response):
+            yield item
+        return
+
+    params = dict(since=since or None, until=until or None, period=period or None)
+    params = dict((key, value) for key, value in params.items() if value is not None)
+    params['access_token'] = access_token
+
+    for item in iter_url_values(GRAPH_URL + 'v2.5/' + object_id + '/insights/' + metric, 
+                                params, paging):
+        yield item
+
+def iter_url_values(url, params=None, paging=None):
+    """
+    Streaming counterpart of get_url for insight responses (e.g. a paging 
+    link from a previous response); see iter_insight_values
+    """
+    response = get_session().get(url, params=params, timeout=TIMEOUT, stream=True)
+    try:
+        response.raise_for_status()
+        # let urllib3 undo the gzip transfer encoding while streaming
+        response.raw.decode_content = True
+        for item in _parse_insight_values(response.raw, paging):
+            yield item
+    finally:
+        response.close()
+
+def _walk_insight_values(fb_response):
+    for entry in fb_response.get('data', []):
+        for value in entry.get('values', []):
+            yield entry.get('name'), entry.get('period'), value.get('end_time'), value.get('value')
+
+def _parse_insight_values(fileobj, paging=None):
+    if ijson is None:
+        fb_response = json.load(fileobj)
+        if paging is not None:
+            paging.update(fb_response.get('paging', {}))
+        for item in _walk_insight_values(fb_response):
+            yield item
+        return
+
+    name = period = end_time = value = builder = None
+    # values that arrive before their entry's name and period
+    pending = []
+    for prefix, event, data in ijson.parse(fileobj):
+        if builder is not None:
+            builder.event(event, data)
+            if prefix == 'data.item.values.item.value' and event in ('end_map', 'end_array'):
+                value, builder = _decoded(builder.value), None
+        elif prefix == 'data.item.values.item.value':
+            if event in ('start_map', 'start_array'):
+                builder = ijson.common.ObjectBuilder()
+                builder.event(event, data)
+            else:
+                value = _decoded(data)
+        elif prefix == 'data.item.values.item.end_time':
+            end_time = data
+        elif prefix == 'data.item.values.item':
+            if event == 'start_map':
+                end_time = value = None
+            elif event == 'end_map':
+                if name is None or period is None:
+                    pending.append((end_time, value))
+                else:
+                    yield name, period, end_time, value
+        elif prefix == 'data.item.name':
+            name = data
+        elif prefix == 'data.item.period':
+            period = data
+        elif prefix == 'data.item' and event == 'end_map':
+            for end_time, value in pending:
+                yield name, period, end_time, value
+            name = period = None
+            pending = []
+        elif prefix in ('paging.previous', 'paging.next') and paging is not None:
+            paging[prefix[len('paging.'):]] = data
+
+def _decoded(value):
+    """
+    ijson gives non-integral numbers as Decimal; json.load gives floats
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return dict((key, _decoded(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_decoded(item) for item in value]
 
-        current_df = temp_df
+    return value
 
-        while to_date > temp_df.index.max():
-            next_page = current_fb_response['paging']['next']
-            current_fb_response = json.load(ul2.urlopen(next_page))
-            temp_df = insight_to_df(current_fb_response)
-            current_df = pd.concat([current_df, temp_df])
+class InsightColumnsBuilder(object):
+    """
+    Appends streamed (name, period, end_time, value) insight values of one 
+    period into per-metric columns: numbers into a float buffer, anything 
+    else (e.g. per-city dicts) into a list. to_df() builds a DataFrame with 
+    one column per metric, indexed by date (the day before each end_time)
+    """
+    def __init__(self, period='day'):
+        self.period = period
+        self._dates = {}
+        self._values = {}
+        self._integral = {}
+
+    def add(self, values):
+        for name, period, end_time, value in values:
+            if period != self.period:
+                continue
+            if name not in self._dates:
+                self._dates[name] = []
+                self._values[name] = array.array('d')
+                self._integral[name] = True
+
+            column = self._values[name]
+            if isinstance(column, array.array):
+                if value is None:
+                    self._integral[name] = False
+                    value = np.nan
+                elif isinstance(value, (int, long)) and not isinstance(value, bool):
+                    pass
+                elif isinstance(value, float):
+                    self._integral[name] = False
+                else:
+                    column = self._values[name] = column.tolist()
+            self._dates[name].append(end_time[0:10])
+            column.append(value)
+
+        return self
+
+    def to_df(self):
+        columns = {}
+        for name, dates in self._dates.items():
+            values = self._values[name]
+            if isinstance(values, array.array):
+                values = np.frombuffer(values, dtype='d')
+                values = values.astype('int64') if self._integral[name] else values.copy()
+            dates = pd.to_datetime(dates) - pd.Timedelta(days=1)
+            columns[name] = pd.Series(values, index=dates)
+
+        df = pd.DataFrame(columns)
+        df.index.name = 'date'
 
-        df = pd.concat([df, current_df], axis=1)
-        
-    
-    return df
+        return df
 
 #---------------------------------------------------------------------------------
 
 
 def get_cities_date_range(graph, object_id, date_range=['2016-05-01', '2016-10-04']):
+    """
+    page_fans_city over date_range as a DataFrame of dates by cities, 
+    following the response's paging links. Pages are streamed (see 
+    iter_insight_values) into a CityValuesBuilder; only the page being 
+    inspected while walking back to from_date is held in full
+    """
     
     from_date, to_date = string_to_datetime(date_range[0]), string_to_datetime(date_range[1])
     
-    def get_dates_from_fb_response(fb_response):
-        date_list = []
-        for entry in fb_response['data'][0]['values']:
-            date_list.append(string_to_datetime(entry['end_time'][0:10]))
-        date_list = np.array(date_list)
-        return date_list
-    
-    def fb_response_to_df(fb_response):
-        df = pd.DataFrame()
-        for date in fb_response['data'][0]['values']:
-            current_date = string_to_datetime(date['end_time'])
-            for city in date['value']:
-                df.loc[current_date, city] = date['value'][city]
-            
-        
-        return df
-    
-    fb_response = get_insight(graph, object_id, 'page_fans_city')
-    
-    date_list = get_dates_from_fb_response(fb_response)
+    def city_values(values):
+        return ((end_time, counts) for name, period, end_time, counts in values 
+                if name == 'page_fans_city')
+
+    # links from cached responses carry no token, so it is always passed anew
+    token = {'access_token': graph}
+
+    paging = {}
+    page = list(city_values(iter_insight_values(graph, object_id, 'page_fans_city', 
+                                                paging=paging)))
     
-    while from_date < date_list.min():
-        previous_page = fb_response['paging']['previous']
-        fb_response = json.load(ul2.urlopen(previous_page))
-        date_list = get_dates_from_fb_response(fb_response)
-        
-    df = pd.DataFrame()
-    while to_date > date_list.max():
-#         print fb_response
-        current_df = fb_response_to_df(fb_response)
-        df = pd.concat([df, current_df])
+    while page and from_date < string_to_datetime(min(end_time for end_time, _ in page)):
+        previous_page, paging = _strip_token(paging['previous']), {}
+        page = list(city_values(iter_url_values(previous_page, token, paging)))
         
-        next_page = fb_response['paging']['next']
-        fb_response = json.load(ul2.urlopen(next_page))
-        date_list = get_dates_from_fb_response(fb_response)
-
-    current_df = fb_response_to_df(fb_response)    
-    df = pd.concat([df, current_df])
+    builder = CityValuesBuilder().add_values(page)
+    # the latest end_time seen decides whether another page is needed
+    latest = [max(end_time for end_time, _ in page) if page else None]
+
+    def tracked(values):
+        for end_time, counts in values:
+            latest[0] = max(latest[0], end_time)
+            yield end_time, counts
+
+    while latest[0] is not None and to_date > string_to_datetime(latest[0]):
+        seen, next_page, paging = latest[0], _strip_token(paging['next']), {}
+        builder.add_values(tracked(city_values(iter_url_values(next_page, token, paging))))
+        if latest[0] == seen:
+            # an empty page, nothing further to follow
+            break
     
-    return df
+    return builder.to_wide()
+
+#---------------------------------------------------------------------------------
+
+class InsightStore(object):
+    """
+    Local append-only store of insight time series, one directory per 
+    (object_id, metric, period) under path. Each series is kept as three 
+    binary columns (dates, key codes and values) that sync() only appends 
+    to, fetching just the days after the last one stored. Metrics whose 
+    values are dicts (e.g. page_fans_city) are stored one row per date and 
+    key. query() reads the columns memory-mapped and slices the requested 
+    dates by binary search, so long histories load without parsing
+    """
+    COLUMNS = [('dates', 'int64'), ('keys', 'int32'), ('values', 'float64')]
+
+    def __init__(self, path='insight_store'):
+        self.path = path
+
+    def sync(self, access_token, object_id, metric, period='day', start='2016-01-01', 
+             until=None):
+        """
+        Fetches and appends the dates after the last stored one (or from 
+        start for a new series) up to until, by default yesterday. Returns 
+        the number of rows appended
+        """
+        meta = self._read_meta(object_id, metric, period)
+        if meta['last_date']:
+            from_date = string_to_datetime(meta['last_date']) + datetime.timedelta(days=1)
+        else:
+            from_date = string_to_datetime(start)
+        to_date = (string_to_datetime(until) if until else 
+                   datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        if from_date > to_date:
+            return 0
+
+        # streamed values go straight into the column buffers
+        key_codes = dict((key, code) for code, key in enumerate(meta['keys']))
+        dates, keys, values = array.array('l'), array.array('l'), array.array('d')
+        first_day, last_day = self._day_number(from_date), self._day_number(to_date)
+        seen_day = None
+
+        for since, until in _insight_windows(from_date, to_date):
+            for name, value_period, end_time, value in iter_insight_values(
+                    access_token, object_id, metric, since, until, period):
+                if name != metric or value_period != period:
+                    continue
+                # the value of a day is stamped with the end of that day
+                day = self._day_number(end_time) - 1
+                if not first_day <= day <= last_day:
+                    continue
+                seen_day = day if seen_day is None else max(seen_day, day)
+                if isinstance(value, dict):
+                    dates.extend([day] * len(value))
+                    keys.extend([key_codes.setdefault(key, len(key_codes)) for key in value])
+                    values.extend([float(count) for count in value.values()])
+                elif value is not None:
+                    dates.append(day)
+                    keys.append(-1)
+                    values.append(value)
+
+        if dates:
+            columns = {
+                'dates': np.frombuffer(dates, dtype='l'),
+                'keys': np.frombuffer(keys, dtype='l'), 
+                'values': np.frombuffer(values, dtype='d'),
+                }
+            self._append(object_id, metric, period, meta, columns)
+
+            meta['keys'] = sorted(key_codes, key=key_codes.get)
+            meta['n_rows'] += len(dates)
+            meta['last_date'] = str(np.datetime64(seen_day, 'D'))
+            self._write_meta(object_id, metric, period, meta)
+
+        return len(dates)
+
+    def query(self, object_id, metric, period='day', since=None, until=None):
+        """
+        The stored series between since and until (inclusive). Scalar metrics 
+        come back as a Series indexed by date; dict-valued metrics as a 
+        DataFrame of dates by keys
+        """
+        meta = self._read_meta(object_id, metric, period)
+        columns = self._map_columns(object_id, metric, period, meta['n_rows'])
+
+        dates = columns['dates']
+        start = 0 if since is None else np.searchsorted(dates, self._day_number(since))
+        stop = (len(dates) if until is None else 
+                np.searchsorted(dates, self._day_number(until), side='right'))
+
+        index = (dates[start:stop].astype('datetime64[D]')).astype('datetime64[ns]')
+        keys, values = columns['keys'][start:stop], columns['values'][start:stop]
+
+        if not meta['keys']:
+            return pd.Series(np.array(values), index=pd.DatetimeIndex(index, name='date'), 
+                             name=metric)
+
+        unique_dates, date_codes = np.unique(index, return_inverse=True)
+        wide = np.full((len(unique_dates), len(meta['keys'])), np.nan)
+        wide[date_codes, keys] = values
+
+        return pd.DataFrame(wide, index=pd.DatetimeIndex(unique_dates, name='date'), 
+                            columns=meta['keys'])
+
+    def last_synced(self, object_id, metric, period='day'):
+        return self._read_meta(object_id, metric, period)['last_date']
+
+    def _series_path(self, object_id, metric, period):
+        key = json.dumps([object_id, metric, period])
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _read_meta(self, object_id, metric, period):
+        meta_path = os.path.join(self._series_path(object_id, metric, period), 'meta.json')
+        if not os.path.isfile(meta_path):
+            return {'object_id': object_id, 'metric': metric, 'period': period, 
+                    'last_date': None, 'n_rows': 0, 'keys': []}
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self, object_id, metric, period, meta):
+        series_path = self._series_path(object_id, metric, period)
+        tmp_path = os.path.join(series_path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        # the row count in meta.json is what makes appended rows visible
+        if os.path.exists(os.path.join(series_path, 'meta.json')):
+            os.remove(os.path.join(series_path, 'meta.json'))
+        os.rename(tmp_path, os.path.join(series_path, 'meta.json'))
+
+    def _append(self, object_id, metric, period, meta, columns):
+        series_path = self._series_path(object_id, metric, period)
+        if not os.path.isdir(series_path):
+            os.makedirs(series_path)
+
+        for name, dtype in self.COLUMNS:
+            with open(os.path.join(series_path, name + '.bin'), 'ab') as f:
+                # drop anything an interrupted sync wrote past the last committed row
+                f.truncate(meta['n_rows'] * np.dtype(dtype).itemsize)
+                f.write(columns[name].astype(dtype).tobytes())
+
+    def _map_columns(self, object_id, metric, period, n_rows):
+        series_path = self._series_path(object_id, metric, period)
+        columns = {}
+        for name, dtype in self.COLUMNS:
+            if n_rows:
+                columns[name] = np.memmap(os.path.join(series_path, name + '.bin'), 
+                                          dtype=dtype, mode='r', shape=(n_rows,))
+            else:
+                columns[name] = np.zeros(0, dtype=dtype)
+
+        return columns
+
+    @staticmethod
+    def _day_number(date):
+        return np.datetime64(str(date)[0:10], 'D').astype('int64')
 
 #---------------------------------------------------------------------------------
 
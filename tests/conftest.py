@@ -0,0 +1,154 @@
+"""
+Shared fixtures: an in-memory stand-in for a pymongo collection and a local
+HTTP server standing in for the Graph API
+"""
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import urlparse
+
+import pytest
+
+#---------------------------------------------------------------------------------
+
+_MISSING = object()
+
+def _comparable(value, other):
+    # mongo range operators only match values of the same BSON type
+    if value is _MISSING or value is None:
+        return False
+    numbers = (int, long, float)
+    return type(value) == type(other) or (isinstance(value, numbers) and
+                                          isinstance(other, numbers))
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(document, part) for part in condition):
+                return False
+        elif key == '$nor':
+            if any(_matches(document, part) for part in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(key, _MISSING)
+            for operator, operand in condition.items():
+                if operator == '$exists':
+                    if (value is not _MISSING) != operand:
+                        return False
+                elif operator == '$ne':
+                    if (None if value is _MISSING else value) == operand:
+                        return False
+                elif not _comparable(value, operand) or not {
+                        '$gt': value > operand, '$gte': value >= operand,
+                        '$lt': value < operand, '$lte': value <= operand}[operator]:
+                    return False
+        elif document.get(key) != condition:
+            return False
+
+    return True
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        # missing and null keys sort before every other value, as in mongo
+        rank = lambda document: ((0, None) if document.get(key) is None
+                                 else (1, document[key]))
+        return FakeCursor(sorted(self, key=rank, reverse=direction < 0))
+
+    def limit(self, n):
+        return FakeCursor(self[:n])
+
+    def batch_size(self, size):
+        return self
+
+class FakeCollection(object):
+    """
+    The subset of a pymongo collection mongo_to_df uses; queries records
+    every query passed to find
+    """
+    def __init__(self, documents, name='fake'):
+        self.documents = documents
+        self.name = name
+        self.full_name = 'test.' + name
+        self.queries = []
+
+    def find(self, query={}, projection=None):
+        self.queries.append(query)
+        found = FakeCursor()
+        for document in self.documents:
+            if not _matches(document, query):
+                continue
+            if projection:
+                document = dict((key, value) for key, value in document.items()
+                                if key == '_id' or projection.get(key))
+            found.append(dict(document))
+
+        return found
+
+#---------------------------------------------------------------------------------
+
+class GraphStub(object):
+    """
+    Local Graph API server. handler(method, path, params) returns a JSON
+    body, or a (body, status, headers) tuple; requests lists every
+    (method, path, params) received
+    """
+    def __init__(self):
+        self.handler = lambda method, path, params: {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                self._respond('GET', url.path, dict(urlparse.parse_qsl(url.query)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._respond('POST', urlparse.urlparse(self.path).path,
+                              dict(urlparse.parse_qsl(body)))
+
+            def _respond(self, method, path, params):
+                stub.requests.append((method, path, params))
+                reply = stub.handler(method, path, params)
+                body, status, headers = reply if isinstance(reply, tuple) else (reply, 200, {})
+                raw = json.dumps(body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def graph(monkeypatch):
+    """
+    A GraphStub that databox.fb sends every Graph API call to
+    """
+    from databox import fb
+
+    stub = GraphStub()
+    monkeypatch.setattr(fb, 'GRAPH_URL', stub.url)
+    monkeypatch.setattr(fb, 'BACKOFF_BASE', 0)
+    monkeypatch.setattr(fb, '_insight_cache', None)
+    monkeypatch.setattr(fb, '_insight_plan', None)
+    yield stub
+    stub.close()
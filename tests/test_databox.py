@@ -0,0 +1,102 @@
+import collections
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from databox import databox
+from databox import mongo_to_df
+
+from conftest import FakeCollection
+
+#---------------------------------------------------------------------------------
+
+def make_documents(n=100):
+    return [{'_id': i, 'ts': float(i), 'name': 'doc%d' % i, 'user': {'age': i % 7}}
+            for i in range(n)]
+
+def test_mongo_to_df_matches_list_of_dicts():
+    documents = make_documents(25)
+    df = mongo_to_df(FakeCollection(documents), batch_size=4)
+
+    expected = pd.DataFrame(documents)
+    assert list(df.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(df, expected[sorted(expected.columns)])
+
+def test_mongo_to_df_missing_fields_and_dtypes():
+    documents = [{'_id': 0, 'a': 1}, {'_id': 1, 'b': 'x'}, {'_id': 2, 'a': 3, 'b': 'y'}]
+    df = mongo_to_df(FakeCollection(documents), batch_size=2, dtypes={'a': 'float32'})
+
+    assert list(df.columns) == ['_id', 'a', 'b']
+    assert df['a'].dtype == np.float32
+    assert np.isnan(df['a'][1])
+    assert df['b'].tolist()[1:] == ['x', 'y']
+
+def test_mongo_to_df_ordered_dtypes_come_first():
+    dtypes = collections.OrderedDict([('ts', 'float64'), ('name', object)])
+    df = mongo_to_df(FakeCollection(make_documents(5)), dtypes=dtypes)
+
+    assert list(df.columns) == ['ts', 'name', '_id', 'user']
+
+def test_mongo_to_df_flatten():
+    df = mongo_to_df(FakeCollection(make_documents(10)), flatten=True)
+
+    assert list(df.columns) == ['_id', 'name', 'ts', 'user.age']
+    assert df['user.age'].tolist() == [i % 7 for i in range(10)]
+
+def test_mongo_to_df_chunksize():
+    chunks = list(mongo_to_df(FakeCollection(make_documents(25)), chunksize=10))
+
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert pd.concat(chunks)['_id'].tolist() == list(range(25))
+
+@pytest.mark.parametrize('partitions', [4, [10.0, 50.0]])
+def test_mongo_to_df_partitions_keep_every_document(partitions):
+    documents = make_documents() + [{'_id': 100}, {'_id': 101, 'ts': None},
+                                    {'_id': 102, 'ts': 'late'}]
+    df = mongo_to_df(FakeCollection(documents), partitions=partitions, partition_key='ts')
+
+    assert sorted(df['_id'].tolist()) == list(range(103))
+    assert df['_id'].tolist()[:100] == list(range(100))
+    assert list(df.columns) == ['_id', 'name', 'ts', 'user']
+
+def test_mongo_to_df_partitions_respect_query():
+    df = mongo_to_df(FakeCollection(make_documents()), {'_id': {'$gte': 50}},
+                     partitions=3, partition_key='ts')
+
+    assert df['_id'].tolist() == list(range(50, 100))
+
+def test_mongo_to_df_cache_fetches_only_newer_documents(tmpdir):
+    collection = FakeCollection(make_documents(10))
+    first = mongo_to_df(collection, cache_dir=str(tmpdir))
+
+    collection.documents.extend(make_documents(15)[10:])
+    collection.queries = []
+    refreshed = mongo_to_df(collection, cache_dir=str(tmpdir))
+
+    assert collection.queries == [{'_id': {'$gt': 9}}]
+    assert refreshed['_id'].tolist() == list(range(15))
+    assert list(refreshed.columns) == list(first.columns)
+
+#---------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('alpha', [0.05, 0.2])
+def test_sequential_mc_pca_decides_as_fixed_n(alpha):
+    rng = np.random.RandomState(0)
+    signal = rng.normal(size=(60, 1))
+    df = pd.DataFrame(np.hstack([signal + rng.normal(scale=s, size=(60, 3))
+                                 for s in (0.5, 3.0)]))
+
+    fixed = databox.mc_pca(df, N=199, batch_size=10, random_state=1)
+    sequential = databox.mc_pca(df, N=199, batch_size=10, random_state=1,
+                                sequential=True, alpha=alpha)
+
+    assert ((sequential['P-value'] <= alpha) == (fixed['P-value'] <= alpha)).all()
+    assert (sequential['Replicates'] <= 199).all()
+    assert sequential['Replicates'].min() < 199
+
+def test_sequential_mc_pca_rejects_unreachable_alpha():
+    df = pd.DataFrame(np.random.RandomState(0).normal(size=(20, 3)))
+
+    with pytest.raises(ValueError):
+        databox.mc_pca(df, N=10, sequential=True, alpha=0.01)
@@ -0,0 +1,178 @@
+import os
+
+import pytest
+import requests
+
+from databox import fb
+
+#---------------------------------------------------------------------------------
+
+def test_graph_get_sends_token_and_drops_none_params(graph):
+    graph.handler = lambda method, path, params: {'id': path.split('/')[-1]}
+
+    assert fb.graph_get('token', 'v2.5/123', fields='name', since=None) == {'id': '123'}
+    assert graph.requests == [('GET', '/v2.5/123', {'fields': 'name', 'access_token': 'token'})]
+
+def test_graph_get_raises_on_http_errors(graph):
+    graph.handler = lambda method, path, params: ({'error': {'code': 100}}, 400, {})
+
+    with pytest.raises(requests.HTTPError):
+        fb.graph_get('token', 'v2.5/123')
+
+def test_session_is_shared():
+    assert fb.get_session() is fb.get_session()
+
+#---------------------------------------------------------------------------------
+
+def failing_then_ok(failures):
+    """
+    Handler answering each object's first len(failures) requests with the
+    given (body, status, headers) replies, then with its insights
+    """
+    calls = {}
+    def handler(method, path, params):
+        object_id = path.split('/')[2]
+        attempt = calls[object_id] = calls.get(object_id, 0) + 1
+        if attempt <= len(failures):
+            return failures[attempt - 1]
+        return {'data': [{'name': path.split('/')[-1], 'values': []}]}
+    return handler
+
+@pytest.mark.parametrize('failure', [
+    ({}, 429, {}),
+    ({}, 503, {}),
+    ({'error': {'code': 613, 'message': 'Calls to this api have exceeded the rate limit'}}, 400, {}),
+    ({'error': {'code': 4}}, 403, {}),
+])
+def test_fetch_insights_retries_throttled_requests(graph, failure):
+    graph.handler = failing_then_ok([failure, failure])
+
+    results = dict(fb.fetch_insights('token', ['1', '2', '3'], ['page_fans', 'page_views']))
+
+    assert sorted(results) == ['1', '2', '3']
+    assert results['1'] == {'data': [{'name': 'page_fans,page_views', 'values': []}]}
+    assert len(graph.requests) == 9
+
+def test_fetch_insights_gives_up_after_max_retries(graph):
+    graph.handler = failing_then_ok([({}, 429, {})] * 10)
+
+    with pytest.raises(requests.HTTPError):
+        list(fb.fetch_insights('token', ['1'], 'page_fans', max_retries=2))
+    assert len(graph.requests) == 3
+
+def test_fetch_insights_does_not_retry_other_errors(graph):
+    graph.handler = failing_then_ok([({'error': {'code': 100}}, 400, {})])
+
+    with pytest.raises(requests.HTTPError):
+        list(fb.fetch_insights('token', ['1'], 'page_fans'))
+    assert len(graph.requests) == 1
+
+def test_fetch_insights_backs_off_on_reported_usage(graph):
+    graph.handler = lambda method, path, params: (
+        {'data': []}, 200, {'X-App-Usage': '{"call_count": 95, "total_time": 10}'})
+
+    limiter = fb._AdaptiveLimiter(8)
+    fb._throttled_get('token', 'v2.5/1/insights/page_fans', {}, limiter, max_retries=0)
+
+    assert limiter.limit == 1
+
+#---------------------------------------------------------------------------------
+
+def insights(method, path, params):
+    """
+    Daily values for every metric in an /insights/m1,m2 path, ending on each
+    day after since up to until, with a paging link carrying the token
+    """
+    since = fb.string_to_datetime(params.get('since', '2016-10-01'))
+    until = fb.string_to_datetime(params.get('until', '2016-10-02'))
+    days = [since + fb.datetime.timedelta(days=i + 1) for i in range((until - since).days)]
+    data = [{'name': metric, 'period': 'day',
+             'values': [{'value': i, 'end_time': day.strftime('%Y-%m-%dT07:00:00+0000')}
+                        for i, day in enumerate(days)]}
+            for metric in path.split('/')[-1].split(',')]
+    paging = {'next': 'https://graph.facebook.com' + path + '?access_token=' +
+                      params['access_token'] + '&since=1475650800'}
+    return {'data': data, 'paging': paging}
+
+def test_insight_cache_serves_repeated_requests(graph, tmpdir):
+    graph.handler = insights
+    cache = fb.enable_insight_cache(str(tmpdir.join('cache.sqlite')))
+    try:
+        first = fb.get_insight('token', '1', 'page_fans', since='2016-09-01', until='2016-09-03')
+        second = fb.get_insight('token', '1', 'page_fans', since='2016-09-01', until='2016-09-03')
+    finally:
+        fb.disable_insight_cache()
+
+    assert len(graph.requests) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second['data'] == first['data']
+    assert 'token' not in second['paging']['next']
+    assert 'since=1475650800' in second['paging']['next']
+
+def test_insight_cache_expires_only_recent_windows(tmpdir):
+    cache = fb.InsightCache(str(tmpdir.join('cache.sqlite')), recent_ttl=-1)
+    closed = ('1', 'page_fans', None, '2016-09-01', '2016-09-03')
+    recent = ('1', 'page_fans', None, None, None)
+    cache.put(closed, {'data': []})
+    cache.put(recent, {'data': []})
+
+    assert cache.get(closed) == {'data': []}
+    assert cache.get(recent) is None
+
+def test_insight_cache_evicts_least_recently_used(tmpdir):
+    cache = fb.InsightCache(str(tmpdir.join('cache.sqlite')), max_bytes=250)
+    keys = [(str(i), 'page_fans', None, '2016-09-01', '2016-09-03') for i in range(3)]
+    for key in keys:
+        # random bytes do not compress, so each body takes over 100 bytes
+        cache.put(key, {'data': [{'name': 'page_fans', 'id': os.urandom(60).encode('hex')}]})
+
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) is not None
+
+#---------------------------------------------------------------------------------
+
+def test_insight_plan_merges_requests_into_one_call(graph):
+    graph.handler = insights
+    plan = fb.InsightPlan('token')
+    fans = plan.add('1', 'page_fans', since='2016-09-24', until='2016-10-02')
+    cities = plan.add('1', 'page_fans_city', since='2016-10-01', until='2016-10-02')
+    other = plan.add('2', 'page_fans', since='2016-10-01', until='2016-10-02')
+
+    assert sorted(plan.queries()) == [
+        ('1', 'page_fans,page_fans_city', None, '2016-09-24', '2016-10-02'),
+        ('2', 'page_fans', None, '2016-10-01', '2016-10-02')]
+
+    fans_response = plan.result(fans)
+    assert [entry['name'] for entry in fans_response['data']] == ['page_fans']
+    assert len(fans_response['data'][0]['values']) == 8
+    assert [entry['name'] for entry in plan.result(cities)['data']] == ['page_fans_city']
+    assert len(plan.result(cities)['data'][0]['values']) == 1
+    assert plan.result(other)['data'][0]['name'] == 'page_fans'
+    assert len(graph.requests) == 2
+
+def test_insight_plan_answers_get_insight_inside_with(graph):
+    graph.handler = insights
+    plan = fb.InsightPlan('token')
+    plan.add('1', 'page_fans', since='2016-09-24', until='2016-10-02')
+    plan.add('1', 'page_fans_city', since='2016-10-01', until='2016-10-02')
+
+    with plan:
+        fb.get_insight('token', '1', 'page_fans', since='2016-09-30', until='2016-10-02')
+        fb.get_insight('token', '1', 'page_fans_city', since='2016-10-01', until='2016-10-02')
+        assert len(graph.requests) == 1
+        fb.get_insight('token', '1', 'page_fans', since='2016-08-01', until='2016-08-02')
+        assert len(graph.requests) == 2
+
+    fb.get_insight('token', '1', 'page_fans', since='2016-09-30', until='2016-10-02')
+    assert len(graph.requests) == 3
+
+def test_insight_plan_paging_links_request_own_metric(graph):
+    graph.handler = insights
+    plan = fb.InsightPlan('token')
+    request = plan.add('1', 'page_fans_city')
+    plan.add('1', 'page_fans')
+
+    next_link = plan.result(request)['paging']['next']
+
+    assert '/insights/page_fans_city?' in next_link
+    assert 'since=1475650800' in next_link